@@ -0,0 +1,691 @@
+#!/usr/bin/env python3
+#
+# mftbench.py
+#
+# (c) Authors: Miguel Quero & Javier Marin (Based in mft work of Omer BenAmram)
+# e-mail: motrilwireless@gmail.com
+# company: Alpine Security
+#
+# ***************************************************************
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+#
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import struct
+import tempfile
+import time
+import tracemalloc
+
+import mftmactime
+import pytz
+
+from mft import PyMftParser, PyMftAttributeX10, PyMftAttributeX30
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+RECORD_SIZE = 1024
+CLUSTER_SIZE = 4096
+BASE_FILETIME = 132000000000000000
+SYSTEM_FILES = ["$MFT", "$MFTMirr", "$LogFile", "$Volume", "$AttrDef", ".", "$Bitmap",
+                "$Boot", "$BadClus", "$Secure", "$UpCase", "$Extend"]
+PAYLOADS = [b"", b"[.ShellClassInfo]\r\nIconResource=%SystemRoot%\\system32\\shell32.dll\r\n",
+            b"[ZoneTransfer]\r\nZoneId=3\r\n"]
+USN_PAGE = 4096
+# Reasons of a file life: create, write, rename (old and new name), close, delete
+USN_REASONS = [0x100, 0x2, 0x80000002, 0x1000, 0x2000, 0x80002000, 0x80000200]
+SORT_BUDGET = 64 * 1024 ** 2
+YARA_RULE = 'rule bench_zone { strings: $a = "ZoneId=3" condition: $a }'
+
+########################### SYNTHETIC MFT ##############################
+
+def resident_attribute(atype, content, name="", attr_id=0):
+    name_data = name.encode("utf-16-le")
+    name_offset = 0x18
+    content_offset = (name_offset + len(name_data) + 7) & ~7
+    length = (content_offset + len(content) + 7) & ~7
+    attribute = bytearray(length)
+    struct.pack_into("<IIBBHHHIHBB", attribute, 0, atype, length, 0, len(name), name_offset,
+                     0, attr_id, len(content), content_offset, 0, 0)
+    attribute[name_offset:name_offset + len(name_data)] = name_data
+    attribute[content_offset:content_offset + len(content)] = content
+    return bytes(attribute)
+
+
+def nonresident_attribute(atype, size, lcn, name="", attr_id=0):
+    clusters = max(1, (size + CLUSTER_SIZE - 1) // CLUSTER_SIZE)
+    name_data = name.encode("utf-16-le")
+    name_offset = 0x40
+    runs_offset = (name_offset + len(name_data) + 7) & ~7
+    # Single data run: 4 bytes length, 4 bytes LCN
+    runs = b"\x44" + struct.pack("<Ii", clusters, lcn) + b"\x00"
+    length = (runs_offset + len(runs) + 7) & ~7
+    attribute = bytearray(length)
+    struct.pack_into("<IIBBHHHQQHH4xQQQ", attribute, 0, atype, length, 1, len(name), name_offset,
+                     0, attr_id, 0, clusters - 1, runs_offset, 0, clusters * CLUSTER_SIZE, size, size)
+    attribute[name_offset:name_offset + len(name_data)] = name_data
+    attribute[runs_offset:runs_offset + len(runs)] = runs
+    return bytes(attribute)
+
+
+def standard_information(times, file_attributes):
+    created, modified, mft_modified, accessed = times
+    return struct.pack("<4Q6I2Q", created, modified, mft_modified, accessed, file_attributes,
+                       0, 0, 0, 0, 0, 0, 0)
+
+
+def file_name(parent, parent_seq, times, size, file_attributes, name):
+    created, modified, mft_modified, accessed = times
+    return struct.pack("<7QIIBB", parent | (parent_seq << 48), created, modified, mft_modified,
+                       accessed, (size + CLUSTER_SIZE - 1) & ~(CLUSTER_SIZE - 1), size,
+                       file_attributes, 0, len(name), 3) + name.encode("utf-16-le")
+
+
+def file_record(entry, seq, attrs, in_use=True, directory=False, base=0):
+    """
+    Build a 1024 bytes FILE record with its update sequence fixups applied
+    """
+    record = bytearray(RECORD_SIZE)
+    offset = 0x38
+    for attribute in attrs:
+        record[offset:offset + len(attribute)] = attribute
+        offset += len(attribute)
+    record[offset:offset + 4] = b"\xff\xff\xff\xff"
+    flags = (1 if in_use else 0) | (2 if directory else 0)
+    base_ref = (base | (1 << 48)) if base else 0
+    struct.pack_into("<4sHHQHHHHIIQHHI", record, 0, b"FILE", 0x30, 3, 0, seq, 1, 0x38,
+                     flags, offset + 8, RECORD_SIZE, base_ref, len(attrs), 0, entry)
+    struct.pack_into("<H", record, 0x30, 1)
+    for sector in range(2):
+        end = (sector + 1) * 512 - 2
+        record[0x32 + sector * 2:0x34 + sector * 2] = record[end:end + 2]
+        struct.pack_into("<H", record, end, 1)
+    return bytes(record)
+
+
+def generate_mft(mftfile, entries=10000, seed=1, deleted_ratio=0.1, resident_ratio=0.4,
+                 ads_ratio=0.05, usn_size=2 * 1024 * 1024):
+    """
+    Write a synthetic $MFT with system files, a directory tree, allocated and
+    deleted files with resident or non resident data, resident ADS and
+    extension records holding non resident ADS. Returns the (entry,
+    sequence, parent, parent sequence, name) of the files
+    """
+    rnd = random.Random(seed)
+
+    def times():
+        created = BASE_FILETIME + rnd.randrange(0, 10 ** 15) // 10 * 10
+        # Half of the timestamps are repeated to get joined MACB groups
+        return [created] + [created if rnd.random() < 0.5 else
+                            created + rnd.randrange(0, 10 ** 13) // 10 * 10 for _ in range(3)]
+
+    dirs = [5]
+    files = list()
+    lcn = 1000
+    with open(mftfile, "wb") as f:
+        for entry in range(max(entries, 32)):
+            if entry < len(SYSTEM_FILES):
+                directory = entry in (5, 11)
+                attrs = [resident_attribute(0x10, standard_information(times(), 0x6)),
+                         resident_attribute(0x30, file_name(5, 5, times(), 0, 0x10000000 if directory
+                                                            else 0x6, SYSTEM_FILES[entry]))]
+                if entry == 0:
+                    attrs.append(nonresident_attribute(0x80, entries * RECORD_SIZE, lcn))
+                f.write(file_record(entry, entry or 1, attrs, directory=directory))
+            elif entry == 12:
+                attrs = [resident_attribute(0x10, standard_information(times(), 0x26)),
+                         resident_attribute(0x30, file_name(11, 11, times(), 0, 0x26, "$UsnJrnl")),
+                         nonresident_attribute(0x80, usn_size, lcn + 16, name="$J"),
+                         resident_attribute(0x80, b"\x00" * 32, name="$Max")]
+                f.write(file_record(entry, 1, attrs))
+            elif entry < 16:
+                f.write(file_record(entry, 1, [], in_use=False))
+            elif entry < 16 + max(2, entries // 50):
+                parent = rnd.choice(dirs)
+                t = times()
+                attrs = [resident_attribute(0x10, standard_information(t, 0x10)),
+                         resident_attribute(0x30, file_name(parent, 5 if parent == 5 else 1, t, 0,
+                                                            0x10000000, "dir{}".format(entry)))]
+                f.write(file_record(entry, 1, attrs, directory=True))
+                dirs.append(entry)
+            elif rnd.random() < ads_ratio / 2:
+                # Extension record, its base entry can be before or after it
+                base = entry + rnd.randrange(1, 5) if rnd.random() < 0.5 else rnd.randrange(16, entry)
+                attrs = [nonresident_attribute(0x80, rnd.randrange(1000, 10 ** 6), lcn,
+                                               name="ads{}".format(entry))]
+                f.write(file_record(entry, 1, attrs, base=base))
+            else:
+                parent = rnd.choice(dirs)
+                parent_seq = 5 if parent == 5 else 1
+                name = "file{}.{}".format(entry, rnd.choice(["txt", "ini", "log", "dll", "exe", "dat"]))
+                t = times()
+                attrs = [resident_attribute(0x10, standard_information(t, 0x20))]
+                if rnd.random() < resident_ratio:
+                    if rnd.random() < 0.5:
+                        data = rnd.choice(PAYLOADS)
+                    else:
+                        data = bytes(rnd.randrange(256) for _ in range(rnd.randrange(1, 400)))
+                    attrs.append(resident_attribute(0x30, file_name(parent, parent_seq, t, len(data), 0x20, name)))
+                    attrs.append(resident_attribute(0x80, data))
+                else:
+                    size = rnd.randrange(1000, 10 ** 7)
+                    attrs.append(resident_attribute(0x30, file_name(parent, parent_seq, t, size, 0x20, name)))
+                    attrs.append(nonresident_attribute(0x80, size, lcn))
+                    lcn += (size + CLUSTER_SIZE - 1) // CLUSTER_SIZE
+                if rnd.random() < ads_ratio:
+                    attrs.append(resident_attribute(0x80, PAYLOADS[2], name="Zone.Identifier"))
+                in_use = rnd.random() >= deleted_ratio
+                seq = rnd.randrange(1, 20)
+                f.write(file_record(entry, seq, attrs, in_use=in_use))
+                files.append((entry, seq, parent, parent_seq, name))
+    return files
+
+########################### SYNTHETIC USN ##############################
+
+def usn_record(usn, entry, seq, parent, parent_seq, timestamp, reason, name):
+    filename = name.encode("utf-16-le")
+    length = (60 + len(filename) + 7) & ~7
+    record = bytearray(length)
+    mftmactime.USN_RECORD_V2.pack_into(record, 0, length, 2, 0, entry | (seq << 48),
+                                       parent | (parent_seq << 48), usn, timestamp, reason,
+                                       0, 0, 0x20, len(filename), 60)
+    record[60:60 + len(filename)] = filename
+    return bytes(record)
+
+
+def generate_usn(usnfile, files, records=100000, seed=1, sparse=16 * USN_PAGE, gap_ratio=0.01):
+    """
+    Write a synthetic $J: a sparse run of null bytes, then V2 records of the
+    MFT files going through create, write, rename, close and delete, with
+    null gaps up to the next page as the journal leaves when it wraps.
+    Reused entries get a new sequence. Returns the number of records
+    """
+    rnd = random.Random(seed)
+    files = list(files) or [(64, 1, 5, 5, "file64.txt")]
+    timestamp = BASE_FILETIME
+    with open(usnfile, "wb") as f:
+        f.write(b"\x00" * sparse)
+        usn = sparse
+        for _ in range(records):
+            index = rnd.randrange(len(files))
+            entry, seq, parent, parent_seq, name = files[index]
+            reason = rnd.choice(USN_REASONS)
+            if reason == 0x2000:
+                name = "renamed{}.{}".format(entry, name.rpartition(".")[2])
+                files[index] = (entry, seq, parent, parent_seq, name)
+            elif reason == 0x80000200:
+                files[index] = (entry, seq + 1, parent, parent_seq, name)
+            timestamp += rnd.randrange(1, 10 ** 7)
+            record = usn_record(usn, entry, seq, parent, parent_seq, timestamp, reason, name)
+            f.write(record)
+            usn += len(record)
+            if rnd.random() < gap_ratio:
+                gap = USN_PAGE - usn % USN_PAGE
+                f.write(b"\x00" * gap)
+                usn += gap
+    return records
+
+########################### MEMORY BENCHMARK ###########################
+
+def record_times(file_record):
+    """
+    Collect the SI and FN MACB groups of a record as {filetime: macb mask}
+    """
+    si = dict()
+    fn = dict()
+    ftype = ""
+    for attribute_record in file_record.attributes():
+        if isinstance(attribute_record, RuntimeError):
+            continue
+        attribute_data = attribute_record.attribute_content
+        if isinstance(attribute_data, PyMftAttributeX10):
+            times = si
+            ftype = attribute_data.file_flags
+        elif isinstance(attribute_data, PyMftAttributeX30):
+            times = fn
+        else:
+            continue
+        mftmactime.join_macb(times, mftmactime.attribute_filetimes(attribute_data))
+    return si, fn, ftype
+
+
+def build_events(mftfile, compact):
+    """
+    Build the SI and FN timeline events of an MFT, as the old list of dicts
+    (one dict, datetime and path/flags strings per event) or as compact
+    TimelineEvent records
+    """
+    events = list()
+    for file_record in PyMftParser(mftfile).entries():
+        if isinstance(file_record, RuntimeError):
+            continue
+        si, fn, ftype = record_times(file_record)
+        full_path = "C:/{}".format(file_record.full_path)
+        if compact:
+            fn_path = "{} ($FILE_NAME)".format(full_path)
+            flags = file_record.flags
+            for times, path in ((si, full_path), (fn, fn_path)):
+                for date, macb in times.items():
+                    events.append(mftmactime.TimelineEvent(
+                        date, file_record.file_size, file_record.entry_id, path, flags, macb, ftype))
+        else:
+            for date, macb in si.items():
+                events.append({"file_size": file_record.file_size, "full_path": full_path,
+                               "inode": file_record.entry_id, "flags": file_record.flags,
+                               "date": mftmactime.filetime_to_datetime(date),
+                               "date_flags": mftmactime.MACB_FLAGS[macb], "ftype": ftype})
+            for date, macb in fn.items():
+                events.append({"file_size": file_record.file_size,
+                               "full_path": "{} ($FILE_NAME)".format(full_path),
+                               "inode": file_record.entry_id, "flags": file_record.flags,
+                               "date": mftmactime.filetime_to_datetime(date),
+                               "date_flags": mftmactime.MACB_FLAGS[macb], "ftype": ftype})
+    return events
+
+
+def bench_memory(mftfile):
+    results = dict()
+    for name, compact in (("dict", False), ("compact", True)):
+        gc.collect()
+        tracemalloc.start()
+        events = build_events(mftfile, compact)
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results[name] = used / len(events)
+        print("  + {:<8} EVENTS: {}  BYTES/EVENT: {:.1f}".format(name.upper(), len(events), results[name]))
+        del events
+    print("  + REDUCTION: {:.1f}x".format(results["dict"] / results["compact"]))
+    return results
+
+
+########################### WRITER BENCHMARK ###########################
+
+def legacy_save_mft_to_file(mft, output_path, timezone):
+    """
+    Timeline writer before DateFormatter: pytz zone lookup, astimezone and
+    strftime for every row
+    """
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write("Date,Size,Type,Mode,UID,GID,Meta,File Name\n")
+        for entry in mft:
+            if "DIRECTORY" in entry.ftype:
+                ftype = "d/drwxrwxrwx"
+            else:
+                ftype = "-/-rwxrwxrwx"
+
+            if timezone:
+                thistz = pytz.timezone(timezone)
+                formatted_date = mftmactime.filetime_to_datetime(entry.date).astimezone(thistz).strftime("%a %b %d %Y %H:%M:%S (%Z)")
+            else:
+                formatted_date = mftmactime.filetime_to_datetime(entry.date).strftime("%a %b %d %Y %H:%M:%S (%Z)")
+
+            if "ALLOCATED" in entry.flags:
+                fflag = ""
+            elif "USN" in entry.flags:
+                fflag = entry.flags
+            else:
+                fflag = "(deleted)"
+            f.write("{},{},{},{},{},{},{},{} {}\n".format(formatted_date, entry.file_size, mftmactime.MACB_FLAGS[entry.date_flags], ftype, 0, 0, entry.inode, entry.full_path, fflag))
+
+
+def bench_writer(mftfile, workdir, timezone):
+    events = sorted(build_events(mftfile, True), key=mftmactime.EVENT_DATE)
+    results = dict()
+    outputs = dict()
+    for name, writer in (("legacy", legacy_save_mft_to_file), ("cached", mftmactime.save_mft_to_file)):
+        outputs[name] = os.path.join(workdir, "{}.csv".format(name))
+        start = time.perf_counter()
+        writer(events, outputs[name], timezone)
+        results[name] = len(events) / (time.perf_counter() - start)
+        print("  + {:<8} ROWS: {}  ROWS/SEC: {:.0f}".format(name.upper(), len(events), results[name]))
+    with open(outputs["legacy"], "rb") as legacy, open(outputs["cached"], "rb") as cached:
+        identical = legacy.read() == cached.read()
+    print("  + SPEEDUP: {:.1f}x  IDENTICAL OUTPUT: {}".format(results["cached"] / results["legacy"], identical))
+    return results
+
+
+########################### STAGE BENCHMARK ############################
+
+def start_stage():
+    """
+    Reset the peak RSS of the process (Linux 4.0+, writing 5 to
+    /proc/self/clear_refs) and return the start time of a stage
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    return time.perf_counter()
+
+
+def stage_peak_rss():
+    """
+    Peak resident set size in KiB since the last start_stage (VmHWM),
+    None where it can not be reset per stage
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def current_rss():
+    """
+    Resident set size of the process in KiB (VmRSS), None if unknown
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def bench_sort_budget(workdir, max_memory=SORT_BUDGET, seed=1):
+    """
+    Sort a stream of synthetic events four times the size of the budget
+    and check that the peak RSS does not grow more than max_memory over the
+    RSS before the sort. Events are built on the fly, as the parsers do,
+    with a path shared by the 8 SI/FN events of an entry
+    """
+    rnd = random.Random(seed)
+    count = 4 * max_memory // mftmactime.EVENT_MEMORY
+    gc.collect()
+    baseline = current_rss()
+    start = start_stage()
+    timeline = mftmactime.TimelineSorter(max_memory, workdir)
+    for entry in range(count // 8):
+        full_path = "C:/dir{}/dir{}/file{}.txt".format(entry % 97, entry % 1013, entry)
+        for macb in range(8):
+            timeline.append(mftmactime.TimelineEvent(BASE_FILETIME + rnd.randrange(10 ** 15), 1024 + entry,
+                                                     entry, full_path, "ALLOCATED", 1 << (macb % 4), "ARCHIVE"))
+    rows = sum(1 for _ in timeline)
+    seconds = time.perf_counter() - start
+    peak = stage_peak_rss()
+    growth = peak - baseline if peak is not None and baseline is not None else None
+    result = {"events": rows, "runs": timeline.spilled, "seconds": seconds,
+              "budget_kb": max_memory // 1024, "rss_growth_kb": growth}
+    print("  + EVENTS: {}  RUNS: {}  BUDGET: {} KB  PEAK RSS GROWTH: {} KB".format(
+        rows, timeline.spilled, result["budget_kb"], growth))
+    if growth is not None and growth * 1024 > max_memory:
+        raise AssertionError("sort peak RSS grew {} KB over its {} KB budget".format(growth, result["budget_kb"]))
+    return result
+
+
+def peak_rss():
+    """
+    Peak resident set size of the whole process in KiB, None where the
+    resource module is not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux and BSD KiB
+    return peak // 1024 if platform.system() == "Darwin" else peak
+
+
+def stage_result(name, seconds, records, events, output_bytes):
+    result = {"seconds": seconds,
+              "records": records,
+              "events": events,
+              "bytes": output_bytes,
+              "records_per_sec": records / seconds if seconds else 0.0,
+              "events_per_sec": events / seconds if seconds else 0.0,
+              "bytes_per_sec": output_bytes / seconds if seconds else 0.0,
+              "peak_rss_kb": stage_peak_rss()}
+    print("  + {:<14} {:>9.3f}s  RECORDS/SEC: {:>10.0f}  EVENTS/SEC: {:>10.0f}  MB/SEC: {:>8.1f}  STAGE PEAK RSS: {} KB".format(
+        name.upper(), seconds, result["records_per_sec"], result["events_per_sec"],
+        result["bytes_per_sec"] / 1e6, result["peak_rss_kb"]))
+    return result
+
+
+def bench_stages(mftfile, usnfile, workdir, timezone, workers=1, max_memory=None, yara_file=None):
+    """
+    Run the pipeline stages one after the other over the same input and
+    measure records/sec, events/sec, bytes/sec (input of the parsers,
+    output of the writers, scanned data of YARA) and the peak RSS of the
+    process while every stage runs (it includes the data kept from the
+    previous stages, not the worker processes)
+    """
+    stages = dict()
+    resident_path = os.path.join(workdir, "resident")
+
+    start = start_stage()
+    records = list(mftmactime.mft_records(mftfile, "C", True, resident_path, None, True, workers))
+    paths = mftmactime.PathIndex("C")
+    events = list()
+    for record in records:
+        if record.asndate is not None:
+            paths.add_entry(record.inode, record.sequence, record.full_path, record.file_size, record.asndate)
+        for date, date_flags in record.timesx10:
+            events.append(mftmactime.TimelineEvent(date, record.file_size, record.inode, record.full_path,
+                                                   record.flags, date_flags, record.ftypex10))
+        fn_path = "{} ($FILE_NAME)".format(record.full_path)
+        for date, date_flags in record.timesx30:
+            events.append(mftmactime.TimelineEvent(date, record.file_size, record.inode, fn_path,
+                                                   record.flags, date_flags, record.ftypex30))
+    stages["mft_parse"] = stage_result("MFT PARSE", time.perf_counter() - start, len(records),
+                                       len(events), os.path.getsize(mftfile))
+
+    if usnfile:
+        start = start_stage()
+        usn_count = 0
+        for (entry, sequence, parent_entry, parent_sequence, usn, timestamp, reason,
+             file_attributes, filename) in mftmactime.usn_records(usnfile):
+            usn_path, file_size = paths.resolve_usn(entry, sequence, parent_entry, parent_sequence, filename)
+            if not 0 <= timestamp <= mftmactime.FILETIME_MAX:
+                continue
+            events.append(mftmactime.TimelineEvent(timestamp, file_size, entry, usn_path,
+                                                   "(USN: {})".format(mftmactime.decodeReasons(reason)), 0,
+                                                   mftmactime.decodeAttributes(file_attributes)))
+            usn_count += 1
+        stages["usn_parse"] = stage_result("USN PARSE", time.perf_counter() - start, usn_count,
+                                           usn_count, os.path.getsize(usnfile))
+
+    start = start_stage()
+    timeline = mftmactime.TimelineSorter(max_memory, workdir)
+    for event in events:
+        timeline.append(event)
+    timeline = list(timeline)
+    stages["sort"] = stage_result("SORT", time.perf_counter() - start, len(timeline), len(timeline), 0)
+    del events
+
+    csv_path = os.path.join(workdir, "timeline.csv")
+    start = start_stage()
+    rows = mftmactime.save_mft_to_file(timeline, csv_path, timezone)
+    stages["csv_write"] = stage_result("CSV WRITE", time.perf_counter() - start, rows, rows,
+                                       os.path.getsize(csv_path))
+    del timeline
+
+    residents = [resident for record in records for resident in record.resident]
+    start = start_stage()
+    report = mftmactime.ResidentReport(resident_path, None)
+    for resident in residents:
+        report.add(resident)
+    report.close()
+    stages["resident_dump"] = stage_result("RESIDENT DUMP", time.perf_counter() - start, len(residents),
+                                           report.totalres, sum(len(r.data) for r in residents))
+
+    if yara_file:
+        rules = mftmactime.yara.compile(filepath=yara_file)
+    else:
+        rules = mftmactime.yara.compile(source=YARA_RULE)
+    matches = list()
+    start = start_stage()
+    scanner = mftmactime.YaraScanner(rules, 1, lambda resident, match: matches.append(match))
+    for resident in residents:
+        scanner.submit(resident)
+    scanner.close()
+    stages["yara"] = stage_result("YARA", time.perf_counter() - start, len(residents),
+                                  sum(1 for match in matches if match), sum(len(r.data) for r in residents))
+    return stages
+
+
+def compare_results(baseline_file, stages):
+    """
+    Print the throughput of every stage against a previous JSON result
+    """
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    print("- COMPARED WITH: {} ({})".format(baseline_file, baseline.get("version")))
+    for name, result in stages.items():
+        old = baseline.get("stages", dict()).get(name)
+        if not old:
+            continue
+        metric = "records_per_sec"
+        if old[metric] and result[metric]:
+            print("  + {:<14} RECORDS/SEC: {:>10.0f} -> {:>10.0f}  ({:+.1f}%)".format(
+                name.upper(), old[metric], result[metric], 100.0 * (result[metric] / old[metric] - 1)))
+
+
+def get_args():
+    argparser = argparse.ArgumentParser(
+        description='Benchmarks of mftmactime over synthetic MFT files')
+
+    argparser.add_argument('-e', '--entries',
+                           required=False,
+                           type=int,
+                           default=100000,
+                           help='Number of MFT entries of the synthetic MFT. Default: 100000')
+
+    argparser.add_argument('-s', '--seed',
+                           required=False,
+                           type=int,
+                           default=1,
+                           help='Random seed of the synthetic MFT. Default: 1')
+
+    argparser.add_argument('-m', '--mft',
+                           required=False,
+                           action='store',
+                           help='Use this MFT file instead of generating a synthetic one')
+
+    argparser.add_argument('-tz', '--timezone',
+                           required=False,
+                           action='store',
+                           default='Europe/Madrid',
+                           help='Timezone of the writer benchmark. Default: Europe/Madrid')
+
+    argparser.add_argument('-u', '--usn-records',
+                           required=False,
+                           type=int,
+                           default=100000,
+                           help='Number of records of the synthetic USN journal. Default: 100000')
+
+    argparser.add_argument('-j', '--usn',
+                           required=False,
+                           action='store',
+                           help='Use this USN journal ($J) instead of generating a synthetic one')
+
+    argparser.add_argument('-w', '--workers',
+                           required=False,
+                           type=int,
+                           default=1,
+                           help='Worker processes of the MFT parse stage. Default: 1')
+
+    argparser.add_argument('--max-memory',
+                           required=False,
+                           action='store',
+                           help='Memory budget of the sort stage and of the sort budget check (e.g. 512M, 2G). Default: 64M for the check')
+
+    argparser.add_argument('-y', '--yara',
+                           required=False,
+                           action='store',
+                           help='YARA rules file of the YARA stage. Default: a single string rule')
+
+    argparser.add_argument('-o', '--output',
+                           required=False,
+                           action='store',
+                           help='Save the results as JSON in this file')
+
+    argparser.add_argument('-c', '--compare',
+                           required=False,
+                           action='store',
+                           help='Compare the stage results with a previous JSON result file')
+
+    return argparser.parse_args()
+
+
+def main():
+    args = get_args()
+    with tempfile.TemporaryDirectory() as workdir:
+        mftfile = args.mft
+        files = list()
+        if not mftfile:
+            mftfile = os.path.join(workdir, "MFT")
+            print("- GENERATING SYNTHETIC MFT: {} ENTRIES".format(args.entries))
+            files = generate_mft(mftfile, args.entries, args.seed)
+
+        usnfile = args.usn
+        if not usnfile and args.usn_records:
+            usnfile = os.path.join(workdir, "UsnJrnl")
+            print("- GENERATING SYNTHETIC USN JOURNAL: {} RECORDS".format(args.usn_records))
+            generate_usn(usnfile, files, args.usn_records, args.seed)
+
+        results = {"version": mftmactime.VERSION,
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                   "mft": args.mft or "synthetic",
+                   "usn": args.usn or "synthetic",
+                   "entries": args.entries,
+                   "usn_records": args.usn_records,
+                   "seed": args.seed,
+                   "workers": args.workers}
+
+        print("- MEMORY BENCHMARK")
+        results["memory"] = bench_memory(mftfile)
+
+        print("- TIMELINE WRITER BENCHMARK")
+        results["writer"] = bench_writer(mftfile, workdir, args.timezone)
+
+        max_memory = mftmactime.parse_size(args.max_memory) if args.max_memory else None
+        print("- SORT MEMORY BUDGET BENCHMARK")
+        results["sort_budget"] = bench_sort_budget(workdir, max_memory or SORT_BUDGET, args.seed)
+
+        print("- STAGE BENCHMARK")
+        results["stages"] = bench_stages(mftfile, usnfile, workdir, args.timezone, args.workers,
+                                         max_memory, args.yara)
+        # Resetting the stage peaks also resets ru_maxrss, the process peak is the highest of all
+        peaks = [peak_rss()] + [stage["peak_rss_kb"] for stage in results["stages"].values()]
+        results["process_peak_rss_kb"] = max((peak for peak in peaks if peak is not None), default=None)
+        print("  + PROCESS PEAK RSS: {} KB".format(results["process_peak_rss_kb"]))
+
+    if args.compare:
+        compare_results(args.compare, results["stages"])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("- RESULTS SAVED: {}".format(args.output))
+
+
+# *** MAIN LOOP ***
+if __name__ == '__main__':
+    main()
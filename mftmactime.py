@@ -34,11 +34,63 @@ import collections
 import pytsk3
 import platform
 import yara
+import heapq
+import pickle
+import tempfile
+import sys
+import io
+import itertools
+import multiprocessing
+import bisect
+import mmap
+import re
+import functools
+import time
+import concurrent.futures
+import hashlib
+import threading
+import tarfile
+import zipfile
+import sqlite3
+import csv
+import json
+import contextlib
+import multiprocessing.connection
+import cProfile
+import gzip
+import queue
+import fnmatch
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
 
 from mft import PyMftParser, PyMftAttributeX10, PyMftAttributeX30, PyMftAttributeX80
-from operator import itemgetter
+from operator import attrgetter
 from tqdm import tqdm
-from datetime import datetime
+from datetime import datetime, timedelta
 from os import path
 
 UTC=pytz.UTC
@@ -46,36 +98,410 @@ BUFF_SIZE = 1024 * 1024
 OS=platform.system()
 VERSION="0.9.1"
 YARA_VERSION=yara.__version__
+SPILL_CHUNK = 4096
+EVENT_MEMORY = 256
+EVENT_DATE = attrgetter("date")
+FLAG_CACHE_SIZE = 4096
+YARA_THREADS = min(32, os.cpu_count() or 1)
+YARA_QUEUE_DEPTH = 64
+YARA_TOP_RULES = 10
+RESIDENT_WRITERS = 4
+RESIDENT_QUEUE = 4096
+ARROW_BATCH = 65536
+PATH_MAX_DEPTH = 256
+CHECKPOINT_SECONDS = 300
+STREAM_MEMORY = 512 * 1024 ** 2
+WRITE_CHUNK = 8192
+COMPRESS_QUEUE = 16
+COMPRESS_LEVELS = {"gzip": 6, "zstd": 3}
+EXTRACT_WRITERS = 4
+EXTRACT_QUEUE = 64
+EXTRACT_HEADER = 64 * 1024
 
 ########################### IMG SUPPORT ################################
 
+class ImageSession:
+    """
+    Opens a RAW image once and keeps its filesystems (FS_Info) by offset,
+    so every extraction from the same evidence reuses them. Split and E01
+    images can take a long time to open, the setup time of the first open
+    is counted as saved on every reuse
+    """
+
+    def __init__(self, imgfile):
+        self.imgfile = imgfile
+        start = time.perf_counter()
+        self.img = pytsk3.Img_Info(imgfile)
+        self.img_time = time.perf_counter() - start
+        self.filesystems = dict()
+        self.fs_times = dict()
+        self.extractions = 0
+        self.saved = 0.0
+
+    def filesystem(self, offset):
+        if offset in self.filesystems:
+            self.saved += self.fs_times[offset]
+        else:
+            start = time.perf_counter()
+            self.filesystems[offset] = pytsk3.FS_Info(self.img, offset=offset)
+            self.fs_times[offset] = time.perf_counter() - start
+        if self.extractions:
+            self.saved += self.img_time
+        self.extractions += 1
+        return self.filesystems[offset]
+
+    def dump(self, dump_path, offset, inode, filename):
+        f = self.filesystem(offset).open_meta(inode = inode)
+
+        filesize = 0
+        thisoffset = 0
+        for i in f:
+            if (i.info.type == pytsk3.TSK_FS_ATTR_TYPE_NTFS_DATA):
+                thissize = i.info.size
+                if thissize > filesize:
+                    filesize = thissize
+
+        thisfile = "{}/{}".format(dump_path, filename)
+        os.makedirs(os.path.dirname(thisfile), exist_ok=True)
+        # Only a complete dump gets its final name
+        of = open(thisfile + ".part","wb")
+        pbar = tqdm(total = filesize,  desc = "  + DUMPING {}".format(filename))
+        while thisoffset < filesize:
+            available_to_read = min(BUFF_SIZE, filesize - thisoffset)
+            data = f.read_random(thisoffset, available_to_read,1)
+            if not data:
+                break
+            thisoffset += len(data)
+            of.write(data)
+            pbar.update(available_to_read)
+        of.close()
+        os.replace(thisfile + ".part", thisfile)
+        return thisfile
+
+
+IMAGE_SESSIONS = dict()
+
+
+def image_session(imgfile):
+    """
+    Return the ImageSession of a RAW image, opening it on first use
+    """
+    key = os.path.realpath(imgfile)
+    if key not in IMAGE_SESSIONS:
+        IMAGE_SESSIONS[key] = ImageSession(imgfile)
+    return IMAGE_SESSIONS[key]
+
+
 def inode_seek_and_dump(imgfile, dump_path, offset, inode, filename):
-    img = pytsk3.Img_Info(imgfile)
-    fs = pytsk3.FS_Info(img, offset=offset)
-    f = fs.open_meta(inode = inode)
-
-    filesize = 0
-    thisoffset = 0
-    for i in f:
-        if (i.info.type == pytsk3.TSK_FS_ATTR_TYPE_NTFS_DATA):
-            thissize = i.info.size
-            if thissize > filesize:
-                filesize = thissize
-
-    thisfile = "{}/{}".format(dump_path, filename)
-    os.makedirs(os.path.dirname(thisfile), exist_ok=True)
-    of = open(thisfile,"wb")
-    pbar = tqdm(total = filesize,  desc = "  + DUMPING {}".format(filename))
-    while thisoffset < filesize:
-        available_to_read = min(BUFF_SIZE, filesize - thisoffset)
-        data = f.read_random(thisoffset, available_to_read,1)
-        if not data:
+    return image_session(imgfile).dump(dump_path, offset, inode, filename)
+
+def data_runs(fs, offset, inode):
+    """
+    Size and extents (file offset, image offset or None if sparse, length)
+    of the unnamed $DATA attribute of an inode, the one read by TSK
+    read_random. Extents are None when the data can not be read raw from
+    the image (resident, compressed or encrypted)
+    """
+    block_size = fs.info.block_size
+    size = 0
+    extents = list()
+    for attr in fs.open_meta(inode = inode):
+        if attr.info.type == pytsk3.TSK_FS_ATTR_TYPE_NTFS_DATA and not attr.info.name:
+            size = attr.info.size
+            if (not attr.info.flags & pytsk3.TSK_FS_ATTR_NONRES or
+                    attr.info.flags & (pytsk3.TSK_FS_ATTR_COMP | pytsk3.TSK_FS_ATTR_ENC)):
+                extents = None
+                continue
+            extents = list()
+            for run in attr:
+                sparse = run.flags & (pytsk3.TSK_FS_ATTR_RUN_FLAG_SPARSE | pytsk3.TSK_FS_ATTR_RUN_FLAG_FILLER)
+                extents.append((run.offset * block_size,
+                                None if sparse else offset + run.addr * block_size,
+                                run.len * block_size))
             break
-        thisoffset += len(data)
-        of.write(data)
-        pbar.update(available_to_read)
-    of.close()
-    return thisfile
+    return size, extents
+
+
+class ImageMftFile(io.RawIOBase):
+    """
+    Read only file object over the $MFT of a RAW image. The $MFT data runs
+    are resolved once and reads go straight to the image extents (sparse
+    runs read as zeros), so PyMftParser can parse it without a dumped copy.
+    A $MFT that can not be read raw (resident, compressed or encrypted) is
+    read through TSK, and a short read raises IOError instead of giving
+    zeroed records. It pickles as (image, offset) and every process reopens
+    the image
+    """
+
+    def __init__(self, imgfile, offset, shared=True):
+        super().__init__()
+        self.imgfile = imgfile
+        self.offset = offset
+        session = image_session(imgfile) if shared else ImageSession(imgfile)
+        self.img = session.img
+        fs = session.filesystem(offset)
+        self.size, extents = data_runs(fs, offset, 0)
+        self.meta = fs.open_meta(inode = 0) if extents is None else None
+        self.extents = extents or list()
+        self.starts = [extent[0] for extent in self.extents]
+        self.pos = 0
+        self.cache_start = 0
+        self.cache = b""
+
+    def __reduce__(self):
+        return (ImageMftFile, (self.imgfile, self.offset, False))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += self.size
+        self.pos = max(0, pos)
+        return self.pos
+
+    def fill(self, pos):
+        """
+        Read BUFF_SIZE bytes of the $MFT from pos following its data runs
+        """
+        size = min(BUFF_SIZE, self.size - pos)
+        if self.meta is not None:
+            data = self.meta.read_random(pos, size)
+            if len(data) < size:
+                raise IOError("short read of the $MFT at offset {}".format(pos))
+            self.cache_start = pos
+            self.cache = data
+            return
+        data = bytearray(size)
+        done = 0
+        while done < size:
+            current = pos + done
+            idx = bisect.bisect_right(self.starts, current) - 1
+            if idx < 0 or current >= self.starts[idx] + self.extents[idx][2]:
+                # Gap without runs, left as zeros up to the next extent
+                following = self.starts[idx + 1] if idx + 1 < len(self.starts) else pos + size
+                done += min(size - done, following - current)
+                continue
+            start, image_offset, length = self.extents[idx]
+            chunk = min(size - done, start + length - current)
+            if image_offset is not None:
+                piece = self.img.read(image_offset + current - start, chunk)
+                if len(piece) < chunk:
+                    raise IOError("short read of the $MFT at offset {}".format(current))
+                data[done:done + len(piece)] = piece
+            done += chunk
+        self.cache_start = pos
+        self.cache = bytes(data)
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        n = min(len(view), max(0, self.size - self.pos))
+        done = 0
+        while done < n:
+            if not self.cache_start <= self.pos < self.cache_start + len(self.cache):
+                self.fill(self.pos)
+            within = self.pos - self.cache_start
+            chunk = min(n - done, len(self.cache) - within)
+            view[done:done + chunk] = self.cache[within:within + chunk]
+            done += chunk
+            self.pos += chunk
+        return done
+
+
+class ExtractSelection:
+    """
+    Non resident files to extract from a RAW image, selected while the MFT
+    is parsed by volume path glob or extension (case insensitive, any
+    separator). Only allocated files are selected, YARA rules are matched
+    later by the ImageExtractor over the first bytes of the candidates
+    """
+
+    def __init__(self, imgfile, offset, extract_path, globs=None, extensions=None, rules=None):
+        self.imgfile = imgfile
+        self.offset = offset
+        self.extract_path = extract_path
+        self.globs = [TimelineFilter.normalize(glob) for glob in globs or ()]
+        self.extensions = tuple(".{}".format(ext.lstrip(".").lower()) for ext in extensions or ())
+        self.rules = rules
+        self.selected = list()
+
+    def add(self, record):
+        if (record.base_inode > 0 or not record.file_size or "ALLOCATED" not in record.flags
+                or "INDEX_PRESENT" in record.flags):
+            return
+        # Volume path without the drive letter, as the resident dumps
+        volume_path = record.full_path.split(":", 1)[-1].lstrip("/\\")
+        normalized = TimelineFilter.normalize(volume_path)
+        if ((self.extensions and normalized.endswith(self.extensions))
+                or any(fnmatch.fnmatchcase(normalized, glob) for glob in self.globs)
+                or (not self.extensions and not self.globs)):
+            self.selected.append((record.inode, volume_path))
+
+
+class ImageExtractor:
+    """
+    Bulk extraction of files from a RAW image with the single handle of
+    its ImageSession. The data runs of all the files are resolved first
+    and the reads are sorted by their physical offset, so the image is
+    read almost sequentially whatever the MFT order is. Chunks are written
+    at their file offset by a pool of writer threads, at most EXTRACT_QUEUE
+    chunks wait in memory and a file only gets its final name when all its
+    chunks are written. Resident, compressed and encrypted data is read
+    through TSK
+    """
+
+    def __init__(self, imgfile, offset, extract_path, threads=EXTRACT_WRITERS):
+        self.session = image_session(imgfile)
+        self.offset = offset
+        self.extract_path = extract_path
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(EXTRACT_QUEUE)
+        self.lock = threading.Lock()
+        self.remaining = dict()
+        self.failed = set()
+        self.errors = 0
+        self.seeks = 0
+        self.read = 0
+
+    def matches(self, fs, inode, size, rules):
+        try:
+            header = fs.open_meta(inode = inode).read_random(0, min(size, EXTRACT_HEADER))
+        except (IOError, OSError):
+            return False
+        return bool(rules.match(data=header))
+
+    def write_chunk(self, part, file_offset, data):
+        try:
+            if data is None:
+                self.failed.add(part)
+            elif part not in self.failed:
+                with open(part, "r+b") as f:
+                    f.seek(file_offset)
+                    f.write(data)
+        except OSError:
+            self.failed.add(part)
+        finally:
+            self.slots.release()
+            self.done(part)
+
+    def done(self, part):
+        with self.lock:
+            self.remaining[part] -= 1
+            if self.remaining[part]:
+                return
+            del self.remaining[part]
+        try:
+            if part in self.failed:
+                os.remove(part)
+            else:
+                os.replace(part, part[:-len(".part")])
+        except OSError:
+            self.failed.add(part)
+
+    def submit(self, part, file_offset, read, *args):
+        """
+        Read a chunk (None on a read error) and queue its write
+        """
+        self.slots.acquire()
+        try:
+            data = read(*args)
+            self.read += len(data)
+        except (IOError, OSError):
+            data = None
+        self.pool.submit(self.write_chunk, part, file_offset, data)
+
+    def extract(self, selected, rules=None):
+        """
+        Extract the selected (inode, volume path) files into extract_path,
+        with rules only the files whose first EXTRACT_HEADER bytes match.
+        Returns the extracted files as (inode, size, filename)
+        """
+        os.makedirs(self.extract_path, exist_ok=True)
+        fs = self.session.filesystem(self.offset)
+        files = list()
+        for inode, full_path in selected:
+            try:
+                size, extents = data_runs(fs, self.offset, inode)
+            except (IOError, OSError):
+                self.errors += 1
+                continue
+            first = min((extent[1] for extent in extents or () if extent[1] is not None), default=-1)
+            files.append((first, inode, full_path, size, extents))
+        files.sort(key=lambda f: f[0])
+        if rules:
+            files = [f for f in files if self.matches(fs, f[1], f[3], rules)]
+
+        # Chunks of raw extents by image offset, the rest through TSK
+        reads = list()
+        tsk_files = list()
+        extracted = list()
+        for first, inode, full_path, size, extents in files:
+            filename = "{}/{}".format(self.extract_path, full_path)
+            part = filename + ".part"
+            try:
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                with open(part, "wb") as f:
+                    f.truncate(size)
+            except OSError:
+                self.errors += 1
+                continue
+            chunks = 0
+            if extents is None:
+                tsk_files.append((inode, part, size))
+                chunks = -(-size // BUFF_SIZE)
+            else:
+                for file_offset, image_offset, length in extents:
+                    length = min(length, size - file_offset)
+                    if image_offset is None or length <= 0:
+                        continue
+                    for done in range(0, length, BUFF_SIZE):
+                        reads.append((image_offset + done, min(BUFF_SIZE, length - done), part, file_offset + done))
+                        chunks += 1
+            extracted.append((inode, size, filename))
+            self.remaining[part] = chunks + 1
+        reads.sort(key=lambda r: r[0])
+
+        pbar = tqdm(total = sum(self.remaining.values()) - len(self.remaining),
+                    desc = "  + EXTRACTING {} FILES".format(len(extracted)))
+        position = None
+        for image_offset, length, part, file_offset in reads:
+            if image_offset != position:
+                self.seeks += 1
+            position = image_offset + length
+            self.submit(part, file_offset, self.session.img.read, image_offset, length)
+            pbar.update(1)
+        for inode, part, size in tsk_files:
+            try:
+                f = fs.open_meta(inode = inode)
+            except (IOError, OSError):
+                self.failed.add(part)
+                with self.lock:
+                    self.remaining[part] = 1
+                continue
+            for file_offset in range(0, size, BUFF_SIZE):
+                self.submit(part, file_offset, f.read_random, file_offset, min(BUFF_SIZE, size - file_offset))
+                pbar.update(1)
+        pbar.close()
+        for part in list(self.remaining):
+            self.done(part)
+        self.pool.shutdown()
+
+        extracted = [f for f in extracted if f[2] + ".part" not in self.failed]
+        self.errors += len(self.failed)
+        with open("{}/extract_summary.txt".format(self.extract_path), "w", buffering=BUFF_SIZE) as report:
+            report.write("INODE, SIZE, FILE PATH\n")
+            for inode, size, filename in extracted:
+                report.write("{},{},{}\n".format(inode, size, filename))
+        return extracted
+
 
 def check_file(file, offset):
     fl = open(file, 'rb')
@@ -147,109 +573,184 @@ sourceInfo[0x2] = 'AUXILIARY_DATA'
 sourceInfo[0x4] = 'REPLICATION_MANAGEMENT'
 sourceInfo[0x8] = 'CLIENT_REPLICATION_MANAGEMENT'
 
-def parseUsn(infile, usn):
-    recordProperties = [
-        'majorVersion',
-        'minorVersion',
-        'fileReferenceNumber',
-        'parentFileReferenceNumber',
-        'usn',
-        'timestamp',
-        'reason',
-        'sourceInfo',
-        'securityId',
-        'fileAttributes',
-        'filenameLength',
-        'filenameOffset'
-    ]
-    recordDict = dict(zip(recordProperties, usn))
-    recordDict['filename'] = filenameHandler(infile, recordDict)
-    recordDict['reason'] = convertAttributes(reasons, recordDict['reason'])
-    recordDict['fileAttributes'] = convertAttributes(
-        attributes, recordDict['fileAttributes'])
-    recordDict['mftSeqNumber'], recordDict['mftEntryNumber'] = convertFileReference(
-        recordDict['fileReferenceNumber'])
-    recordDict['pMftSeqNumber'], recordDict['pMftEntryNumber'] = convertFileReference(
-        recordDict['parentFileReferenceNumber'])
-    reorder = [
-        'filename',
-        'timestamp',
-        'usn',
-        'fileReferenceNumber',
-        'parentFileReferenceNumber',
-        'reason',
-        'fileAttributes',
-        'mftSeqNumber',
-        'mftEntryNumber',
-        'pMftSeqNumber',
-        'pMftEntryNumber',
-        'filenameLength',
-        'filenameOffset',
-        'sourceInfo',
-        'securityId',
-        'majorVersion',
-        'minorVersion'
-    ]
-    recordDict = {key: recordDict[key] for key in reorder}
-    return recordDict
-
-def findFirstRecord(infile):
-    """
-    Returns a pointer to the first USN record found
-    Modified version of Dave Lassalle's 'parseusn.py'
-    https://github.com/sans-dfir/sift-files/blob/master/scripts/parseusn.py
-    """
-    while True:
-        data = infile.read(65536).lstrip(b'\x00')
-        if data:
-            return infile.tell() - len(data)
+USN_RECORD_V2 = struct.Struct('<I2H4Q4I2H')
+USN_RECORD_V2_SIZE = USN_RECORD_V2.size
+USN_NONZERO = re.compile(rb'[^\x00]')
+USN_SEEK_WINDOW = 64 * 1024
+MFT_ENTRY_MASK = 0xFFFFFFFFFFFF
 
 
-def findNextRecord(infile, journalSize):
+def usn_seek(journal, usn, journalSize):
     """
-    There are runs of null bytes between USN records. I'm guessing
-    this is done to ensure that journal records are cluster-aligned on disk.
-    This function reads through these null bytes, returning an offset
-    to the first byte of the the next USN record.
+    Byte offset of the first record from this USN. The USN is the offset
+    of the record in a full sparse $J, so the first aligned header within
+    USN_SEEK_WINDOW bytes (null runs not counted) whose USN is its own
+    offset is a record start. None in any other case (Ex: a stripped $J
+    whose records are not at the offset of their USN), then the journal
+    has to be scanned from the start and filtered by USN
     """
-    while True:
-        try:
-            recordLength = struct.unpack_from('<I', infile.read(4))[0]
-            if recordLength:
-                infile.seek(-4, 1)
-                return infile.tell() + recordLength
-        except struct.error:
-            if infile.tell() >= journalSize:
-                break
+    pos = (usn + 7) & ~7
+    end = pos + USN_SEEK_WINDOW
+    while pos < end and pos + USN_RECORD_V2_SIZE <= journalSize:
+        recordLength, majorVersion = USN_RECORD_V2.unpack_from(journal, pos)[:2]
+        if not recordLength:
+            nonzero = USN_NONZERO.search(journal, pos)
+            if not nonzero:
+                return None
+            end += (nonzero.start() & ~7) - pos
+            pos = max(pos + 8, nonzero.start() & ~7)
+            continue
+        if majorVersion == 2 and USN_RECORD_V2.unpack_from(journal, pos)[5] == pos:
+            return pos
+        pos += 8
+    return None
 
 
-def convertFileReference(buf):
+def usn_records(usnfile, after=None, start=0, first=None):
     """
-    Read, store, unpack, and return FileReference
+    Yield the V2 records of a USN journal ($J) as (entry, sequence, parent
+    entry, parent sequence, usn, timestamp, reason, file attributes,
+    filename). The journal is memory mapped, the sparse runs of null bytes
+    between records are skipped in bulk and the 60 bytes headers are
+    decoded in place without copies.
+    With after, only records with a greater USN are returned, with first,
+    only records from that USN. The scan starts at the byte offset start,
+    or at the record of the last of those USNs when usn_seek finds it
     """
-    b = memoryview(bytearray(struct.pack("<Q", buf)))
-    seq = struct.unpack_from("<h", b[6:8])[0]
-
-    b = memoryview(bytearray(b[0:6]))
-    byteString = ''
+    with open(usnfile, 'rb') as f:
+        journalSize = os.fstat(f.fileno()).st_size
+        if journalSize < USN_RECORD_V2_SIZE:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as journal:
+            pos = start & ~7
+            if after is not None or first is not None:
+                seek = usn_seek(journal, max(after + 1 if after is not None else 0, first or 0), journalSize)
+                if seek is not None and pos < seek:
+                    pos = seek
+            while pos + USN_RECORD_V2_SIZE <= journalSize:
+                (recordLength, majorVersion, minorVersion, fileReference, parentFileReference,
+                 usn, timestamp, reason, sourceInfoFlags, securityId, fileAttributes,
+                 filenameLength, filenameOffset) = USN_RECORD_V2.unpack_from(journal, pos)
+
+                # Records are 8 bytes aligned, jump to the next non null one
+                if not recordLength:
+                    nonzero = USN_NONZERO.search(journal, pos)
+                    if not nonzero:
+                        break
+                    pos = max(pos + 8, nonzero.start() & ~7)
+                    continue
 
-    for i in b[::-1]:
-        byteString += format(i, 'x')
-    entry = int(byteString, 16)
+                if (majorVersion != 2 or recordLength < USN_RECORD_V2_SIZE or
+                        pos + recordLength > journalSize or
+                        filenameOffset + filenameLength > recordLength):
+                    pos += 8
+                    continue
 
-    return seq, entry
+                if (after is None or usn > after) and (first is None or usn >= first):
+                    start = pos + filenameOffset
+                    filename = journal[start:start + filenameLength].decode('utf16', errors='replace')
+                    yield (fileReference & MFT_ENTRY_MASK, fileReference >> 48,
+                           parentFileReference & MFT_ENTRY_MASK, parentFileReference >> 48,
+                           usn, timestamp, reason, fileAttributes, filename)
+                pos += (recordLength + 7) & ~7
 
 
-def filenameHandler(infile, recordDict):
+class PathIndex:
     """
-    Read and return filename
+    Path resolution of the MFT entries for the USN journal and the ADS
+    fixups. MFT entries are kept by entry number with their sequence,
+    interned directory and name, size and access date, instead of one full
+    path list per entry. Journal records add (entry, sequence) -> (parent,
+    name) nodes in journal order, so a record resolves to the path of its
+    parent at that time (renames, moves and reused entries included), and
+    the directory paths built from the parent chains are cached
     """
-    try:
-        filename = struct.unpack_from('<{}s'.format(
-            recordDict['filenameLength']), infile.read(recordDict['filenameLength']))[0]
-        return filename.decode('utf16')
-    except struct.error:
-        return ''
+
+    def __init__(self, drive_letter):
+        self.sep = "\\" if OS == "Windows" else "/"
+        self.root = "{}:".format(drive_letter)
+        self.entries = dict()
+        self.journal = dict()
+        self.dirs = dict()
+
+    def add_entry(self, entry, sequence, full_path, file_size, asndate):
+        directory, _, name = full_path.rpartition(self.sep)
+        self.entries[entry] = (sequence, sys.intern(directory), sys.intern(name), file_size, asndate)
+
+    def entry_path(self, entry):
+        """
+        Return (full path, access date) of an MFT entry, or None
+        """
+        node = self.entries.get(entry)
+        if node is None:
+            return None
+        return node[1] + self.sep + node[2], node[4]
+
+    def directory(self, entry, sequence):
+        ref = entry | (sequence << 48)
+        path = self.dirs.get(ref)
+        if path is not None:
+            return path
+
+        chain = list()
+        for _ in range(PATH_MAX_DEPTH):
+            if entry == 5:
+                path = self.root
+                break
+            ref = entry | (sequence << 48)
+            if ref in self.dirs:
+                path = self.dirs[ref]
+                break
+            node = self.journal.get(ref)
+            if node:
+                chain.append((ref, node[2]))
+                entry, sequence = node[0], node[1]
+                continue
+            node = self.entries.get(entry)
+            if node and node[0] == sequence:
+                path = node[1] + self.sep + node[2]
+                self.dirs[ref] = path
+                break
+            return None
+        else:
+            return None
+
+        for ref, name in reversed(chain):
+            path = path + self.sep + name
+            self.dirs[ref] = path
+        return path
+
+    def resolve_usn(self, entry, sequence, parent_entry, parent_sequence, filename):
+        """
+        Return (path, size) of a journal record and learn its parent and name
+        """
+        size = 0
+        node = self.entries.get(entry)
+        if node and node[0] == sequence:
+            size = node[3]
+
+        parent = self.directory(parent_entry, parent_sequence)
+        if parent is not None:
+            path = parent + self.sep + filename
+        elif node and node[0] == sequence and node[2] == filename:
+            path = node[1] + self.sep + node[2]
+        else:
+            path = filename
+
+        self.learn(entry, sequence, parent_entry, parent_sequence, filename)
+        return path, size
+
+    def learn(self, entry, sequence, parent_entry, parent_sequence, filename):
+        """
+        Record the parent and name of a journal record without resolving it
+        """
+        ref = entry | (sequence << 48)
+        update = (parent_entry, parent_sequence, sys.intern(filename))
+        if self.journal.get(ref) != update:
+            self.journal[ref] = update
+            # A renamed or moved directory changes the cached paths below it
+            if ref in self.dirs:
+                self.dirs.clear()
 
 
 def convertAttributes(attributeType, data):
@@ -260,359 +761,1785 @@ def convertAttributes(attributeType, data):
     return ' '.join(attributeList)
 
 
-########################### MFT SECTION ################################
+def flag_decoder(attributeType):
+    """
+    Memoized convertAttributes for a flag table. Journals only have a few
+    hundred distinct bitmasks, so the strings are built once per bitmask
+    and kept in a bounded LRU cache (cache_info() gives hits and misses)
+    """
+    @functools.lru_cache(maxsize=FLAG_CACHE_SIZE)
+    def decode(data):
+        return convertAttributes(attributeType, data)
+    return decode
+
+
+decodeReasons = flag_decoder(reasons)
+decodeAttributes = flag_decoder(attributes)
+
+
+def flag_cache_stats():
+    """
+    Return (hits, misses) of all the flag decoders
+    """
+    infos = [decodeReasons.cache_info(), decodeAttributes.cache_info()]
+    return sum(i.hits for i in infos), sum(i.misses for i in infos)
+
+
+########################### TIMELINE SECTION ###########################
+
+# MACB bitmask <-> mactime "macb" column
+MACB_M = 0x1
+MACB_A = 0x2
+MACB_C = 0x4
+MACB_B = 0x8
+MACB_FLAGS = ["".join(c if mask & (1 << i) else "." for i, c in enumerate("macb")) for mask in range(16)]
+MACB_MASKS = {flags: mask for mask, flags in enumerate(MACB_FLAGS)}
+MACB_ORDER = (MACB_M, MACB_A, MACB_C, MACB_B)
+
+FILETIME_EPOCH = datetime(1601, 1, 1, tzinfo=UTC)
+FILETIME_NAIVE_EPOCH = datetime(1601, 1, 1)
+FILETIME_UNIX_EPOCH = 116444736000000000
+# HARDCODED DATE FOR ERROR = 1977-01-01 00:00:00 CET = 220921200
+FILETIME_ERROR = FILETIME_UNIX_EPOCH + 220921200 * 10000000
+# Last date that can be formatted in any timezone
+FILETIME_MAX = 2650466880000000000
+
+
+def datetime_to_filetime(date):
+    """
+    Convert an aware datetime into FILETIME (100ns intervals since 1601)
+    """
+    return (date - FILETIME_EPOCH) // timedelta(microseconds=1) * 10
+
+
+def filetime_to_datetime(filetime):
+    """
+    Convert FILETIME (100ns intervals since 1601) into an aware UTC datetime
+    """
+    return FILETIME_EPOCH + timedelta(microseconds=filetime // 10)
+
+
+class TimelineEvent:
+    """
+    Compact timeline event. The date is stored as an int FILETIME, the MACB
+    flags as a small int bitmask and the repeated flag/type strings are
+    interned, so the millions of events of a big MFT share them.
+    """
+    __slots__ = ("date", "file_size", "inode", "full_path", "flags", "date_flags", "ftype")
+
+    def __init__(self, date, file_size, inode, full_path, flags, date_flags, ftype):
+        self.date = date
+        self.file_size = file_size
+        self.inode = inode
+        self.full_path = full_path
+        self.flags = sys.intern(flags)
+        self.date_flags = date_flags
+        self.ftype = sys.intern(ftype)
+
+    def __reduce__(self):
+        return (TimelineEvent, (self.date, self.file_size, self.inode, self.full_path,
+                                self.flags, self.date_flags, self.ftype))
 
-def generator():
+
+def parse_size(value):
+    """
+    Convert a human readable size (Ex: 512M, 4G) into bytes
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = str(value).strip().upper().rstrip('B')
+    try:
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size: {}'.format(value))
+
+
+def event_memory(events):
+    """
+    Bytes per buffered event of a sample: the event and its date, size,
+    inode and path objects (shared objects counted once), plus its slot in
+    the buffer and its sort key slot
+    """
+    if not events:
+        return 0
+    seen = set()
+    total = 0
+    for event in events:
+        for value in (event, event.date, event.file_size, event.inode, event.full_path):
+            if id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+    return total / len(events) + 2 * struct.calcsize("P")
+
+
+def write_run(events, tmp_path, run_dir=None):
+    """
+    Dump an already sorted list of events into an anonymous temporary file
+    (or a named one in run_dir) in chunks, so it can be read back without
+    loading the whole run
+    """
+    if run_dir:
+        run = tempfile.NamedTemporaryFile(dir=run_dir, prefix="timeline-", suffix=".run", delete=False)
+    else:
+        run = tempfile.TemporaryFile(dir=tmp_path)
+    for i in range(0, len(events), SPILL_CHUNK):
+        pickle.dump(events[i:i + SPILL_CHUNK], run, pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def read_run(run):
+    """
+    Yield the events stored in a spilled run, one chunk in memory at a time
+    """
+    run.seek(0)
     while True:
-      yield
-
-def join_mft_datetime_attributes(old_entry, value_to_add):
-    mask = "macb"
-    value_pos = mask.find(value_to_add)
-    new_entry = old_entry[:value_pos] + value_to_add + old_entry[value_pos+1:]
-    return new_entry
-
-def save_mft_to_file(mft, output_path, timezone):
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write("Date,Size,Type,Mode,UID,GID,Meta,File Name\n")
-        for entry in mft:
-            fflag = ""
-            ftype = "r/rrwxrwxrwx" #TODO
-            if "DIRECTORY" in entry["ftype"]:
-                ftype = "d/drwxrwxrwx" #TODO
-            else:
-                ftype = "-/-rwxrwxrwx" #TODO
+        try:
+            chunk = pickle.load(run)
+        except EOFError:
+            break
+        yield from chunk
+    run.close()
+
+
+class TimelineSorter:
+    """
+    Collects timeline events and returns them ordered by date.
+    Without a memory budget events are sorted in memory. With a budget,
+    fixed-size runs are sorted and spilled to temporary files, and then
+    k-way merged on iteration, so the timeline buffer never grows beyond
+    max_memory whatever the size of the MFT. The run size comes from the
+    measured bytes per event (event_memory) of the first SPILL_CHUNK events
+    and of every spilled run, never less than EVENT_MEMORY, and it counts
+    the sort keys. The merge reads SPILL_CHUNK events per run with a fan-in
+    of one run size, so it fits in the same budget. Both modes are stable,
+    equal dates keep the order in which the events were appended.
+    """
+
+    def __init__(self, max_memory=None, tmp_path=None, run_dir=None):
+        self.events = list()
+        self.runs = list()
+        self.spilled = 0
+        self.spill_seconds = 0.0
+        self.tmp_path = tmp_path
+        self.run_dir = run_dir
+        self.max_memory = max_memory
+        self.run_size = None
+        if max_memory:
+            # Resized from the first SPILL_CHUNK events
+            self.run_size = SPILL_CHUNK
+
+    def append(self, event):
+        self.events.append(event)
+        if self.run_size and len(self.events) >= self.run_size:
+            self.resize()
+            if len(self.events) >= self.run_size:
+                self.spill()
+
+    def resize(self):
+        """
+        Size the runs from the measured bytes per event of the buffer
+        """
+        per_event = max(EVENT_MEMORY, event_memory(self.events[:SPILL_CHUNK]))
+        self.run_size = max(SPILL_CHUNK, int(self.max_memory // per_event))
+
+    def spill(self):
+        start = time.perf_counter()
+        self.events.sort(key=EVENT_DATE)
+        self.runs.append(write_run(self.events, self.tmp_path, self.run_dir))
+        self.spilled += 1
+        self.events = list()
+        self.spill_seconds += time.perf_counter() - start
+
+    def __iter__(self):
+        if not self.runs:
+            self.events.sort(key=EVENT_DATE)
+            return iter(self.events)
+
+        if self.events:
+            if self.max_memory:
+                self.resize()
+            self.spill()
+
+        # Keep the merge fan-in bounded so the read buffers fit the budget
+        fanin = max(2, self.run_size // SPILL_CHUNK) if self.run_size else len(self.runs)
+        while len(self.runs) > fanin:
+            self.runs = [self.merge_pass(self.runs[i:i + fanin])
+                         for i in range(0, len(self.runs), fanin)]
+
+        return heapq.merge(*[read_run(r) for r in self.runs], key=EVENT_DATE)
+
+    def save_runs(self):
+        """
+        Spill the events in memory to run_dir, returns the paths of the runs
+        """
+        if self.events:
+            self.spill()
+        return [run.name for run in self.runs]
+
+    def restore_runs(self, run_paths):
+        self.runs = [open(run_path, "rb") for run_path in run_paths]
+        self.spilled = len(self.runs)
+        if self.max_memory:
+            self.resize()
+
+    def merge_pass(self, runs):
+        run = tempfile.TemporaryFile(dir=self.tmp_path)
+        chunk = list()
+        for event in heapq.merge(*[read_run(r) for r in runs], key=EVENT_DATE):
+            chunk.append(event)
+            if len(chunk) >= SPILL_CHUNK:
+                pickle.dump(chunk, run, pickle.HIGHEST_PROTOCOL)
+                chunk = list()
+        if chunk:
+            pickle.dump(chunk, run, pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        return run
+
+
+class TimelineFilter:
+    """
+    Selection of the events of a run: a time window (FILETIME, both ends
+    included) and volume path prefixes to include or exclude (case
+    insensitive, any separator). It is applied while parsing, so MFT
+    dates and journal records out of the selection never become events
+    """
+
+    def __init__(self, start=None, end=None, include=None, exclude=None):
+        self.start = start if start is not None else 0
+        self.end = end if end is not None else FILETIME_MAX
+        self.include = tuple(self.prefix(prefix) for prefix in include or ())
+        self.exclude = tuple(self.prefix(prefix) for prefix in exclude or ())
+
+    @staticmethod
+    def normalize(volume_path):
+        return volume_path.replace("\\", "/").lstrip("/").lower()
+
+    @classmethod
+    def prefix(cls, volume_path):
+        """
+        A prefix ends on a separator, so Users matches Users and Users/...
+        but not UsersBackup
+        """
+        prefix = cls.normalize(volume_path).rstrip("/")
+        return prefix + "/" if prefix else ""
+
+    def in_window(self, filetime):
+        return self.start <= filetime <= self.end
+
+    def selected(self, volume_path):
+        """
+        Check a path of the volume (without drive letter)
+        """
+        if not self.include and not self.exclude:
+            return True
+        # path == prefix or path.startswith(prefix + "/")
+        volume_path = self.normalize(volume_path) + "/"
+        if self.include and not volume_path.startswith(self.include):
+            return False
+        return not (self.exclude and volume_path.startswith(self.exclude))
+
+    def selected_path(self, full_path):
+        """
+        Check a timeline path (Ex: C:/Users/test.txt)
+        """
+        if full_path[1:2] == ":":
+            full_path = full_path[2:]
+        return self.selected(full_path)
+
+
+class RunCheckpoint:
+    """
+    Checkpoints of a run kept in a directory, so an interrupted run can be
+    resumed: the phase (mft, usn or write), the MFT entry cursor, the USN
+    of the next journal record, the sorted runs of the timeline spilled to the directory,
+    the path index, the pending ADS fixups and the resident dump progress.
+    The checkpoint is ignored if the options of the run are not the same
+    """
+
+    def __init__(self, checkpoint_path, options):
+        self.checkpoint_path = checkpoint_path
+        self.options = options
+        self.checkpoint_file = os.path.join(checkpoint_path, "checkpoint.pickle")
+        self.last = time.monotonic()
+        os.makedirs(checkpoint_path, exist_ok=True)
+
+    def due(self):
+        return time.monotonic() - self.last >= CHECKPOINT_SECONDS
+
+    def load(self):
+        if not path.exists(self.checkpoint_file):
+            return None
+        with open(self.checkpoint_file, "rb") as f:
+            checkpoint = pickle.load(f)
+        if checkpoint["options"] != self.options:
+            return None
+        return checkpoint
+
+    def save(self, checkpoint):
+        checkpoint["options"] = self.options
+        with open(self.checkpoint_file + ".tmp", "wb") as f:
+            pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(self.checkpoint_file + ".tmp", self.checkpoint_file)
+        self.last = time.monotonic()
+
+    def clear(self):
+        """
+        Remove the checkpoint and its runs once the run is finished
+        """
+        for name in os.listdir(self.checkpoint_path):
+            if name.startswith(("checkpoint.pickle", "timeline-")):
+                os.remove(os.path.join(self.checkpoint_path, name))
+
+
+class TimelineState:
+    """
+    Per host state of incremental runs, kept in a directory: the sequence
+    number and SI/FN fingerprint of every MFT entry, the last USN processed
+    and the sorted events of the whole timeline as a run file. A new run
+    only emits events for new or changed entries and journal records past
+    the last USN, and merges them into the stored timeline without sorting
+    it again. Events of changed or removed entries are replaced, USN events
+    are always kept. The ADS of extension records are events of their base
+    entry, a changed or removed extension record changes its base: the ADS
+    events of the base are replaced and its other events, unchanged, are
+    kept. The state is ignored if the options that change the events
+    (drive letter, $FILE_NAME) are not the same
+    """
+
+    def __init__(self, state_path, options):
+        self.state_path = state_path
+        self.options = options
+        self.records = dict()
+        self.seen = dict()
+        self.changed = set()
+        self.extensions = dict()
+        self.seen_extensions = dict()
+        self.extended = set()
+        self.usn = None
+        self.last_usn = None
+        self.timeline_file = os.path.join(state_path, "timeline.run")
+
+        state_file = os.path.join(state_path, "state.pickle")
+        if path.exists(state_file) and path.exists(self.timeline_file):
+            with open(state_file, "rb") as f:
+                state = pickle.load(f)
+            if state["options"] == options:
+                self.records = state["records"]
+                self.extensions = state.get("extensions", dict())
+                self.usn = state["usn"]
+                self.last_usn = self.usn
+
+    @staticmethod
+    def fingerprint(record):
+        data = repr((record.timesx10, record.timesx30, record.file_size, record.flags,
+                     record.full_path, record.ads)).encode("utf-8")
+        return hashlib.blake2b(data, digest_size=8).digest()
+
+    def update(self, record):
+        """
+        Store the fingerprint of a record, returns if its events must be
+        emitted. A changed extension record also marks its base entry, if
+        the base was already parsed unchanged only its ADS are replaced
+        """
+        entry = (record.sequence, self.fingerprint(record))
+        self.seen[record.inode] = entry
+        if record.base_inode > 0:
+            self.seen_extensions[record.inode] = (record.base_inode, [ads[0] for ads in record.ads])
+        if self.records.get(record.inode) != entry:
+            self.changed.add(record.inode)
+            if record.base_inode > 0:
+                self.change_base(record.base_inode)
+        return record.inode in self.changed
+
+    def change_base(self, base):
+        if base in self.seen and base not in self.changed:
+            self.extended.add(base)
+        self.changed.add(base)
+
+    def update_usn(self, usn):
+        if self.last_usn is None or usn > self.last_usn:
+            self.last_usn = usn
+
+    def merge(self, events):
+        """
+        Merge the new sorted events into the stored timeline, yields
+        (event, new) while the merged timeline is written to a new run
+        """
+        for inode in self.records.keys() - self.seen.keys():
+            if inode in self.extensions:
+                self.change_base(self.extensions[inode][0])
+        stale = (self.changed - self.extended) | (self.records.keys() - self.seen.keys())
+
+        # ADS of the old and new extension records of the bases only extended
+        ads_paths = collections.defaultdict(set)
+        for extensions in (self.extensions, self.seen_extensions):
+            for base, names in extensions.values():
+                if base in self.extended:
+                    ads_paths[base].update(":{}".format(name) for name in names)
+        ads_paths = {base: tuple(names) for base, names in ads_paths.items()}
+
+        def kept(event):
+            if "USN" in event.flags:
+                return True
+            if event.inode in ads_paths:
+                return not event.full_path.endswith(ads_paths[event.inode])
+            return event.inode not in stale
+
+        previous = list()
+        if self.records:
+            previous = ((event, False) for event in read_run(open(self.timeline_file, "rb"))
+                        if kept(event))
+        merged = heapq.merge(previous, ((event, True) for event in events),
+                             key=lambda item: item[0].date)
+
+        os.makedirs(self.state_path, exist_ok=True)
+        with open(self.timeline_file + ".tmp", "wb") as run:
+            chunk = list()
+            for item in merged:
+                chunk.append(item[0])
+                if len(chunk) >= SPILL_CHUNK:
+                    pickle.dump(chunk, run, pickle.HIGHEST_PROTOCOL)
+                    chunk = list()
+                yield item
+            if chunk:
+                pickle.dump(chunk, run, pickle.HIGHEST_PROTOCOL)
+
+    def save(self):
+        os.replace(self.timeline_file + ".tmp", self.timeline_file)
+        state_file = os.path.join(self.state_path, "state.pickle")
+        with open(state_file + ".tmp", "wb") as f:
+            pickle.dump({"options": self.options, "records": self.seen, "usn": self.last_usn,
+                         "extensions": self.seen_extensions}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(state_file + ".tmp", state_file)
+
+
+class DateFormatter:
+    """
+    Formats FILETIME dates as mactime dates of a timezone. The zone is
+    resolved once and its DST transitions are kept as FILETIME boundaries,
+    so rows only need a bisect when they cross a transition. The timeline
+    is sorted, so the last formatted second is reused for the long runs of
+    events with the same timestamp.
+    """
 
-            if timezone:
-                thistz = pytz.timezone(timezone) 
-                formatted_date = entry["date"].replace(tzinfo=pytz.utc).astimezone(thistz).strftime("%a %b %d %Y %H:%M:%S (%Z)")
+    def __init__(self, timezone=None):
+        tz = pytz.timezone(timezone) if timezone else UTC
+        if getattr(tz, "_utc_transition_times", None):
+            self.bounds = [datetime_to_filetime(UTC.localize(t)) for t in tz._utc_transition_times]
+            infos = [(info[0], info[2]) for info in tz._transition_info]
+        else:
+            self.bounds = [datetime_to_filetime(UTC.localize(datetime.min))]
+            infos = [(tz.utcoffset(None), tz.tzname(None))]
+        self.infos = [(offset // timedelta(microseconds=1) * 10, " ({})".format(tzname))
+                      for offset, tzname in infos]
+        self.bounds.append(float("inf"))
+        self.lookup(datetime_to_filetime(FILETIME_EPOCH))
+        self.second = None
+        self.formatted = None
+
+    def lookup(self, filetime):
+        idx = max(0, bisect.bisect_right(self.bounds, filetime) - 1)
+        self.low = self.bounds[idx] if idx else float("-inf")
+        self.high = self.bounds[idx + 1]
+        self.offset, self.tzname = self.infos[idx]
+
+    def format(self, filetime):
+        second = filetime // 10000000
+        if second == self.second:
+            return self.formatted
+        if not self.low <= filetime < self.high:
+            self.lookup(filetime)
+        local = FILETIME_NAIVE_EPOCH + timedelta(seconds=(filetime + self.offset) // 10000000)
+        self.second = second
+        self.formatted = local.strftime("%a %b %d %Y %H:%M:%S") + self.tzname
+        return self.formatted
+
+
+class TimelineStore:
+    """
+    SQLite timeline store with indexes on date, inode and path, written
+    along with the CSV, so time ranges, inodes or path subtrees can be
+    queried (mftmactime query) without rescanning the CSV. Dates are kept
+    as FILETIME and rows are inserted in timeline order
+    """
+
+    def __init__(self, db_path):
+        if path.exists(db_path):
+            os.remove(db_path)
+        self.db = sqlite3.connect(db_path)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE timeline (date INTEGER, size INTEGER, type TEXT, mode TEXT, "
+                        "meta INTEGER, path TEXT, flag TEXT)")
+        self.rows = list()
+
+    def add(self, date, file_size, macb, mode, inode, full_path, fflag):
+        self.rows.append((date, file_size, macb, mode, inode, full_path, fflag))
+        if len(self.rows) >= SPILL_CHUNK:
+            self.flush()
+
+    def flush(self):
+        self.db.executemany("INSERT INTO timeline VALUES (?, ?, ?, ?, ?, ?, ?)", self.rows)
+        self.rows = list()
+
+    def close(self):
+        self.flush()
+        # Indexes are built once after the bulk load
+        self.db.execute("CREATE INDEX timeline_date ON timeline (date)")
+        self.db.execute("CREATE INDEX timeline_meta ON timeline (meta)")
+        self.db.execute("CREATE INDEX timeline_path ON timeline (path)")
+        self.db.commit()
+        self.db.close()
+
+
+class TimelineArrowWriter:
+    """
+    Columnar timeline export written along with the CSV, as Parquet row
+    groups or Arrow IPC record batches (.arrow/.feather) of ARROW_BATCH
+    rows, so memory stays flat. Dates are int64 UTC timestamps and the
+    repeated macb, mode, flags and type strings are dictionary encoded
+    with one dictionary per column for the whole file, that only grows
+    (IPC files get dictionary deltas)
+    """
+
+    def __init__(self, output_path):
+        dictionary = pa.dictionary(pa.int32(), pa.string())
+        self.schema = pa.schema([
+            ("date", pa.timestamp("us", tz="UTC")),
+            ("size", pa.int64()),
+            ("date_flags", dictionary),
+            ("mode", dictionary),
+            ("inode", pa.int64()),
+            ("full_path", pa.string()),
+            ("flags", dictionary),
+            ("ftype", dictionary)])
+        if output_path.lower().endswith((".arrow", ".feather")):
+            options = pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+            self.writer = pa.ipc.new_file(output_path, self.schema, options=options)
+        else:
+            self.writer = pq.ParquetWriter(output_path, self.schema)
+        self.columns = [list() for _ in self.schema]
+        self.dictionaries = [dict() if pa.types.is_dictionary(field.type) else None
+                             for field in self.schema]
+
+    def encode(self, column, value):
+        dictionary = self.dictionaries[column]
+        index = dictionary.get(value)
+        if index is None:
+            index = dictionary[value] = len(dictionary)
+        return index
+
+    def add(self, entry, mode):
+        date, size, date_flags, modes, inode, full_path, flags, ftype = self.columns
+        date.append((entry.date - FILETIME_UNIX_EPOCH) // 10)
+        size.append(entry.file_size)
+        date_flags.append(self.encode(2, MACB_FLAGS[entry.date_flags]))
+        modes.append(self.encode(3, mode))
+        inode.append(entry.inode)
+        full_path.append(entry.full_path)
+        flags.append(self.encode(6, entry.flags))
+        ftype.append(self.encode(7, entry.ftype))
+        if len(date) >= ARROW_BATCH:
+            self.flush()
+
+    def flush(self):
+        if not self.columns[0]:
+            return
+        arrays = list()
+        for values, field, dictionary in zip(self.columns, self.schema, self.dictionaries):
+            if dictionary is not None:
+                arrays.append(pa.DictionaryArray.from_arrays(pa.array(values, pa.int32()),
+                                                             pa.array(list(dictionary), pa.string())))
             else:
-                formatted_date = entry["date"].strftime("%a %b %d %Y %H:%M:%S (%Z)")
+                arrays.append(pa.array(values, field.type))
+        batch = pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        if isinstance(self.writer, pq.ParquetWriter):
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+        self.columns = [list() for _ in self.schema]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def query_timeline(db_path, start=None, end=None, inode=None, prefix=None):
+    """
+    Yield the (date, size, type, mode, meta, path, flag) rows of a
+    TimelineStore in timeline order. start and end are FILETIME, prefix
+    is a path subtree, all of them are answered from the indexes
+    """
+    conditions = list()
+    params = list()
+    if start is not None:
+        conditions.append("date >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("date < ?")
+        params.append(end)
+    if inode is not None:
+        conditions.append("meta = ?")
+        params.append(inode)
+    if prefix:
+        # Range over the path index instead of a LIKE full scan
+        conditions.append("path >= ? AND path < ?")
+        params.extend([prefix, prefix + "\U0010ffff"])
+    sql = "SELECT date, size, type, mode, meta, path, flag FROM timeline"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY date, rowid"
+    db = sqlite3.connect(db_path)
+    try:
+        yield from db.execute(sql, params)
+    finally:
+        db.close()
+
+
+def timeline_row(formatted_date, file_size, macb, mode, inode, full_path, fflag):
+    return "{},{},{},{},{},{},{},{} {}\n".format(formatted_date, file_size, macb, mode, 0, 0, inode, full_path, fflag)
+
+
+def jsonl_row(formatted_date, filetime, file_size, macb, mode, inode, full_path, fflag):
+    return json.dumps({"date": formatted_date, "filetime": filetime, "size": file_size, "macb": macb,
+                       "mode": mode, "inode": inode, "path": full_path, "flags": fflag}) + "\n"
+
+
+def bodyfile_row(times, file_size, mode, inode, full_path, fflag):
+    """
+    TSK bodyfile line (MD5|name|inode|mode|UID|GID|size|atime|mtime|ctime|crtime)
+    of the (filetime, macb mask) groups of an attribute. A date without
+    MACB flags (USN records) fills the four dates
+    """
+    dates = [0, 0, 0, 0]
+    for filetime, mask in times:
+        seconds = (filetime - FILETIME_UNIX_EPOCH) // 10000000
+        for i in range(4):
+            if not mask or mask & (1 << i):
+                dates[i] = seconds
+    m, a, c, b = dates
+    name = "{} {}".format(full_path, fflag) if fflag else full_path
+    return "0|{}|{}|{}|0|0|{}|{}|{}|{}|{}\n".format(name, inode, mode, file_size, a, m, c, b)
+
+
+########################### METRICS SECTION ############################
 
-            if "ALLOCATED" in entry["flags"]:
-                fflag = ""
-            elif "USN" in entry["flags"]:
-                fflag = entry["flags"]
+def peak_memory():
+    """
+    Peak resident set size of the process in bytes, 0 where the resource
+    module is not available
+    """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux and BSD KiB
+    return peak if platform.system() == "Darwin" else peak * 1024
+
+
+class RunMetrics:
+    """
+    Wall time, CPU time, items, bytes read/written and peak memory of the
+    stages of a run. A stage can be entered many times and stages can be
+    nested (the outer one includes the inner ones). CPU time is the
+    process time, so it includes the threads working for the stage, and
+    the worker processes report their own with add(). The peak memory is
+    the peak RSS of the process when the stage was left. Disabled metrics
+    only cost a method call
+    """
+
+    FIELDS = ("wall_seconds", "cpu_seconds", "items", "bytes_read", "bytes_written", "peak_memory_bytes")
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = collections.OrderedDict()
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def add(self, name, wall=0.0, cpu=0.0, items=0, bytes_read=0, bytes_written=0, peak=False):
+        if not self.enabled:
+            return
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = dict.fromkeys(self.FIELDS, 0)
+        stage["wall_seconds"] += wall
+        stage["cpu_seconds"] += cpu
+        stage["items"] += items
+        stage["bytes_read"] += bytes_read
+        stage["bytes_written"] += bytes_written
+        if peak:
+            stage["peak_memory_bytes"] = max(stage["peak_memory_bytes"], peak_memory())
+
+    @contextlib.contextmanager
+    def stage(self, name, items=0, bytes_read=0, bytes_written=0):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, time.process_time() - cpu,
+                     items, bytes_read, bytes_written, True)
+
+    def timed(self, name, iterable):
+        """
+        Iterate over iterable adding the time spent producing every item
+        to the stage (Ex: the merge of the sorted runs)
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        wall = 0.0
+        cpu = 0.0
+        items = 0
+        iterator = None
+        try:
+            while True:
+                start = time.perf_counter()
+                cpu_start = time.process_time()
+                try:
+                    if iterator is None:
+                        iterator = iter(iterable)
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                wall += time.perf_counter() - start
+                cpu += time.process_time() - cpu_start
+                items += 1
+                yield item
+        finally:
+            self.add(name, wall, cpu, items, peak=True)
+
+    def timed_call(self, name, func):
+        """
+        Wrap func adding the wall time of every call to the stage (only
+        for cheap calls, the CPU time and peak memory are not taken)
+        """
+        if not self.enabled:
+            return func
+
+        def call(*args):
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                self.add(name, time.perf_counter() - start, items=1)
+        return call
+
+    def summary(self):
+        run = {"wall_seconds": time.perf_counter() - self.start,
+               "cpu_seconds": time.process_time() - self.cpu_start,
+               "peak_memory_bytes": peak_memory()}
+        if resource is not None:
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            run["children_cpu_seconds"] = children.ru_utime + children.ru_stime
+        return {"version": VERSION, "run": run, "stages": self.stages}
+
+    def prometheus(self):
+        summary = self.summary()
+        lines = list()
+        for field in self.FIELDS:
+            metric = "mftmactime_stage_{}".format(field)
+            lines.append("# TYPE {} gauge".format(metric))
+            for name, stage in summary["stages"].items():
+                lines.append('{}{{stage="{}"}} {}'.format(metric, name, stage[field]))
+        for field, value in summary["run"].items():
+            metric = "mftmactime_run_{}".format(field)
+            lines.append("# TYPE {} gauge".format(metric))
+            lines.append("{} {}".format(metric, value))
+        return "\n".join(lines) + "\n"
+
+    def save(self, metrics_path, metrics_format="json"):
+        with open(metrics_path, "w") as f:
+            if metrics_format == "prometheus":
+                f.write(self.prometheus())
             else:
-                fflag = "(deleted)"
-            f.write("{},{},{},{},{},{},{},{} {}\n".format(formatted_date, entry["file_size"], entry["date_flags"], ftype, 0, 0, entry["inode"], entry["full_path"], fflag))
+                json.dump(self.summary(), f, indent=2)
+
+
+def profile_call(profiler, profile_path, func, *args, **kwargs):
+    """
+    Run func under cProfile (pstats file) or pyinstrument (HTML or text
+    report), returns its result
+    """
+    if profiler == "pyinstrument":
+        session = pyinstrument.Profiler()
+        session.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            session.stop()
+            with open(profile_path, "w") as f:
+                f.write(session.output_html() if profile_path.endswith(".html") else session.output_text())
 
-def dump_resident_file(resident_path, full_path, data):
+    session = cProfile.Profile()
     try:
-        filename = "{}/{}".format(resident_path, full_path)
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        with open(filename, "wb") as rf:
-            rf.write(data)
-    except:
-        return
+        return session.runcall(func, *args, **kwargs)
+    finally:
+        session.dump_stats(profile_path)
 
-# Check if datatime is out of range, usually when the timestamp is in milliseconds
-def check_mft_datetime_attribute(data, type):
-        
+
+########################### MFT SECTION ################################
+
+def output_compression(output_path):
+    """
+    Compression of an output file by its extension, None if not compressed
+    """
+    lower = output_path.lower()
+    if lower.endswith(".gz"):
+        return "gzip"
+    if lower.endswith((".zst", ".zstd")):
+        return "zstd"
+    if lower.endswith(".lz4"):
+        return "lz4"
+    return None
+
+
+class CompressedOutput:
+    """
+    Text output compressed with gzip, zstd or lz4 by a background thread.
+    Writes are large chunks of joined rows handed over through a bounded
+    queue, so the rows of the next chunk are formatted while the previous
+    one is compressed (zlib, zstd and lz4 release the GIL) and at most
+    COMPRESS_QUEUE chunks wait in memory
+    """
+
+    def __init__(self, output_path, compression):
+        self.raw = open(output_path, "wb")
+        if compression == "zstd":
+            self.stream = zstandard.ZstdCompressor(level=COMPRESS_LEVELS["zstd"]).stream_writer(self.raw)
+        elif compression == "lz4":
+            self.stream = lz4frame.LZ4FrameFile(self.raw, "wb")
+        else:
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode="wb", compresslevel=COMPRESS_LEVELS["gzip"])
+        self.queue = queue.Queue(COMPRESS_QUEUE)
+        self.error = None
+        self.thread = threading.Thread(target=self.compress, daemon=True)
+        self.thread.start()
+
+    def compress(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error is None:
+                try:
+                    self.stream.write(chunk.encode("utf-8"))
+                except Exception as e:
+                    self.error = e
+
+    def write(self, text):
+        if self.error:
+            raise self.error
+        self.queue.put(text)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.stream.close()
+        self.raw.close()
+        if self.error:
+            raise self.error
+
+
+class TimelineWriter:
+    """
+    Writes timeline events as they are added, as mactime CSV rows, JSON
+    Lines or TSK bodyfile lines, to a file or to stdout ("-"), and to the
+    SQLite/Arrow outputs, so a pipe can read the timeline while it is
+    being produced. Rows are joined in chunks of WRITE_CHUNK rows before
+    they are written, and .gz, .zst and .lz4 outputs are compressed by a
+    CompressedOutput. If the reader of stdout goes away (Ex: head), the
+    timeline output stops and the other outputs are still written and
+    closed. Returns the number of rows on close
+    """
+
+    def __init__(self, output_path, timezone, output_format="mactime", sqlite_path=None, arrow_path=None, metrics=None):
+        self.metrics = metrics or RunMetrics(False)
+        self.format_date = self.metrics.timed_call("format", DateFormatter(timezone).format)
+        self.output_format = output_format
+        self.paths = [p for p in (output_path, sqlite_path, arrow_path) if p and p != "-"]
+        self.store = TimelineStore(sqlite_path) if sqlite_path else None
+        self.columnar = TimelineArrowWriter(arrow_path) if arrow_path else None
+        self.rows = 0
+        self.chunk = list()
+        self.write = self.chunk.append
+        self.stdout = output_path == "-"
+        if self.stdout:
+            self.f = open(sys.__stdout__.fileno(), "w", encoding="utf-8", buffering=BUFF_SIZE, closefd=False)
+        elif output_compression(output_path):
+            self.f = CompressedOutput(output_path, output_compression(output_path))
+        else:
+            self.f = open(output_path, "w", encoding="utf-8")
+        if output_format == "mactime":
+            self.write("Date,Size,Type,Mode,UID,GID,Meta,File Name\n")
+
+    def flush(self):
         try:
-            if type == "modified":
-                timestamp = datetime.fromtimestamp(data.modified.timestamp())
-            elif type == "accessed":
-                timestamp = datetime.fromtimestamp(data.accessed.timestamp())
-            elif type == "mft_modified":
-                timestamp = datetime.fromtimestamp(data.mft_modified.timestamp())
-            elif type == "created":
-                timestamp = datetime.fromtimestamp(data.created.timestamp())
-
-        except ValueError:
-                # HARDCODED DATE FOR ERROR = 1977-01-01 00:00:00 = 220921200
-                timestamp = datetime.fromtimestamp(220921200)
-
-        return UTC.localize(timestamp)
-
-
-def mft_parser(mftfile, mftout, drive_letter, file_name, timezone, resident_path, usnfile, offset, dump_path, yara_rules, resident_yara_path):
-    mft = list()
-    fpath = dict()
-    adsres = list()
-    adsnores = dict()
-    totalres = 0
-    totaldel = 0
-    totalyar = 0
-    usninode = None
+            self.f.write("".join(self.chunk))
+        except BrokenPipeError:
+            if not self.stdout:
+                raise
+            self.stdout_closed()
+        self.chunk.clear()
+
+    def stdout_closed(self):
+        """
+        Point stdout to os.devnull once its reader is gone and stop
+        writing the timeline rows
+        """
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.__stdout__.fileno())
+        os.close(devnull)
+        self.write = lambda row: None
+        print("  + STDOUT CLOSED, TIMELINE OUTPUT STOPPED")
+
+    @staticmethod
+    def mode(ftype):
+        if "DIRECTORY" in ftype:
+            return "d/drwxrwxrwx" #TODO
+        return "-/-rwxrwxrwx" #TODO
+
+    @staticmethod
+    def fflag(flags):
+        if "ALLOCATED" in flags:
+            return ""
+        elif "USN" in flags:
+            return flags
+        return "(deleted)"
+
+    def add(self, entry):
+        self.rows += 1
+        ftype = self.mode(entry.ftype)
+        fflag = self.fflag(entry.flags)
+        macb = MACB_FLAGS[entry.date_flags]
+        if self.output_format == "bodyfile":
+            self.write(bodyfile_row(((entry.date, entry.date_flags),), entry.file_size, ftype,
+                                    entry.inode, entry.full_path, fflag))
+        elif self.output_format == "jsonl":
+            self.write(jsonl_row(self.format_date(entry.date), entry.date, entry.file_size, macb, ftype,
+                                 entry.inode, entry.full_path, fflag))
+        else:
+            self.write(timeline_row(self.format_date(entry.date), entry.file_size, macb, ftype, entry.inode, entry.full_path, fflag))
+        if len(self.chunk) >= WRITE_CHUNK:
+            self.flush()
+        if self.store:
+            self.store.add(entry.date, entry.file_size, macb, ftype, entry.inode, entry.full_path, fflag)
+        if self.columnar:
+            self.columnar.add(entry, ftype)
+
+    def add_times(self, times, file_size, inode, full_path, flags, ftype):
+        """
+        Write all the dates of an attribute as a single bodyfile line
+        """
+        self.rows += 1
+        self.write(bodyfile_row(times, file_size, self.mode(ftype), inode, full_path, self.fflag(flags)))
+        if len(self.chunk) >= WRITE_CHUNK:
+            self.flush()
+
+    def close(self):
+        with self.metrics.stage("write"):
+            self.flush()
+            try:
+                self.f.close()
+            except BrokenPipeError:
+                if not self.stdout:
+                    raise
+                self.stdout_closed()
+                self.f.close()
+            if self.store:
+                self.store.close()
+            if self.columnar:
+                self.columnar.close()
+        self.metrics.add("write", items=self.rows, bytes_written=sum(os.path.getsize(p) for p in self.paths))
+        return self.rows
+
+
+class TimelineStream:
+    """
+    Unsorted timeline: the events go to the TimelineWriter as soon as they
+    are appended, nothing is kept in memory
+    """
 
-    if resident_path or resident_yara_path:
-        if resident_path:
-            report_file = "{}/resident_summary.txt".format(resident_path)
+    def __init__(self, writer):
+        self.writer = writer
+        self.runs = list()
+        self.spilled = 0
+        self.spill_seconds = 0.0
+
+    def append(self, event):
+        self.writer.add(event)
+
+    def __iter__(self):
+        return iter(())
+
+
+def save_mft_to_file(mft, output_path, timezone, sqlite_path=None, arrow_path=None, metrics=None, output_format="mactime"):
+    metrics = metrics or RunMetrics(False)
+    writer = TimelineWriter(output_path, timezone, output_format, sqlite_path, arrow_path, metrics)
+    with metrics.stage("write"):
+        add = writer.add
+        for entry in metrics.timed("sort", mft):
+            add(entry)
+    return writer.close()
+
+class ResidentWriter:
+    """
+    Writes the dumped resident files asynchronously. Files go through a
+    pool of writer threads that remember the directories already created,
+    or with an archive (.zip, .tar, .tar.gz) into a single stream written
+    by one thread. Writes of the same path keep their order and at most
+    RESIDENT_QUEUE files are waiting in memory
+    """
+
+    def __init__(self, archive=None, threads=RESIDENT_WRITERS):
+        self.archive = None
+        if archive:
+            os.makedirs(os.path.dirname(os.path.abspath(archive)), exist_ok=True)
+            if archive.lower().endswith(".zip"):
+                self.archive = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+            elif archive.lower().endswith((".tar.gz", ".tgz")):
+                self.archive = tarfile.open(archive, "w:gz")
+            else:
+                self.archive = tarfile.open(archive, "w")
+            threads = 1
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(RESIDENT_QUEUE)
+        self.dirs = set()
+        self.pending = dict()
+        self.lock = threading.Lock()
+
+    def write(self, filename, data, source=None, replace=False):
+        """
+        Queue data to be written in filename. With source the file is
+        hardlinked to it when possible, with replace a previous file is
+        unlinked instead of written through
+        """
+        self.slots.acquire()
+        with self.lock:
+            previous = (self.pending.get(filename), self.pending.get(source))
+            future = self.pool.submit(self.write_file, filename, data, source, replace, previous)
+            self.pending[filename] = future
+        future.add_done_callback(lambda f: self.done(filename, f))
+
+    def done(self, filename, future):
+        with self.lock:
+            if self.pending.get(filename) is future:
+                del self.pending[filename]
+        self.slots.release()
+
+    def write_file(self, filename, data, source, replace, previous):
+        # Tasks run in submission order, waiting on earlier ones can not block
+        for future in previous:
+            if future:
+                future.result()
+        try:
+            if self.archive:
+                self.write_archive(filename, data)
+                return
+
+            dirname = os.path.dirname(filename)
+            if dirname not in self.dirs:
+                os.makedirs(dirname, exist_ok=True)
+                self.dirs.add(dirname)
+            if replace and path.lexists(filename):
+                os.remove(filename)
+            if source:
+                try:
+                    os.link(source, filename)
+                    return
+                except OSError:
+                    pass
+            with open(filename, "wb") as rf:
+                rf.write(data)
+        except Exception:
+            return
+
+    def sync(self):
+        """
+        Wait for the queued files to be written
+        """
+        for _ in range(RESIDENT_QUEUE):
+            self.slots.acquire()
+        for _ in range(RESIDENT_QUEUE):
+            self.slots.release()
+
+    def write_archive(self, filename, data):
+        if isinstance(self.archive, zipfile.ZipFile):
+            self.archive.writestr(filename, data)
         else:
-            report_file = "{}/resident_summary.txt".format(resident_yara_path)
+            info = tarfile.TarInfo(filename)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.archive.addfile(info, io.BytesIO(data))
 
-        os.makedirs(os.path.dirname(report_file), exist_ok=True)
-        with open(report_file, "w") as r:
-            r.write("STATUS, FILE PATH\n")
+    def close(self):
+        self.pool.shutdown()
+        if self.archive:
+            self.archive.close()
 
-    parser = PyMftParser(mftfile)
-    for file_record in tqdm(parser.entries(), desc = "  + PARSING MFT"):
-        if isinstance(file_record, RuntimeError):
-            continue
 
-        ftypex10 = ""
-        ftypex30 = ""
-        resident = False
-        asndate = None
-        yara_match = None
-        rdeleted = "ALLOCATED"
-        mft_entryx10 = dict()
-        mft_entryx30 = dict()
-        adsres.clear()
-        utsm = 220921200
-        utsa = 220921200
-        utsc = 220921200
-        utsb = 220921200
-
-        # PATHs Conversions
-        if OS == "Windows":
-            thisfullpath = "{}:\{}".format(drive_letter, file_record.full_path)
+class ContentCache:
+    """
+    Content addressed cache of resident payloads keyed by their BLAKE2b
+    digest, counting lookups and hits to report the dedup ratio
+    """
+
+    def __init__(self):
+        self.entries = dict()
+        self.lookups = 0
+        self.hits = 0
+
+    @staticmethod
+    def key(data):
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def get(self, key):
+        self.lookups += 1
+        value = self.entries.get(key)
+        if value is not None:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+
+    def ratio(self):
+        return 100.0 * self.hits / self.lookups if self.lookups else 0.0
+
+
+class ResidentReport:
+    """
+    Joins the resident data of the records with their YARA results: dumps
+    the files (all with -r, the matched ones with -ry) through a
+    ResidentWriter, writes the summary report with a single buffered
+    handle and keeps the totals of the run. With hardlinks, a payload
+    already dumped is linked to its first copy instead of written again
+    (not inside archives, where every file is stored). With the progress
+    of a checkpoint, the totals are restored and the report continues
+    where the checkpoint left it
+    """
+
+    def __init__(self, resident_path, resident_yara_path, hardlinks=False, archive=None, progress=None):
+        self.resident_path = resident_path
+        self.resident_yara_path = resident_yara_path
+        self.hardlinks = hardlinks and not archive
+        self.archive = archive
+        self.dumps = ContentCache()
+        self.dumped_paths = dict()
+        self.report_file = None
+        self.report = None
+        self.writer = None
+        self.totalres = 0
+        self.totaldel = 0
+        self.totalyar = 0
+        self.totallinks = 0
+        self.written = 0
+
+        if resident_path or resident_yara_path:
+            if resident_path:
+                self.report_file = "{}/resident_summary.txt".format(resident_path)
+            else:
+                self.report_file = "{}/resident_summary.txt".format(resident_yara_path)
+
+            os.makedirs(os.path.dirname(self.report_file), exist_ok=True)
+            if progress and path.exists(self.report_file):
+                self.report = open(self.report_file, "r+", buffering=BUFF_SIZE)
+                self.report.seek(progress["report_size"])
+                self.report.truncate()
+            else:
+                self.report = open(self.report_file, "w", buffering=BUFF_SIZE)
+                self.report.write("STATUS, FILE PATH\n")
+            self.writer = ResidentWriter(archive)
+
+        if progress:
+            (self.totalres, self.totaldel, self.totalyar, self.totallinks,
+             self.written) = progress["totals"]
+
+    def progress(self):
+        """
+        Wait for the pending files and return the totals and report size
+        """
+        if self.writer:
+            self.writer.sync()
+        if self.report:
+            self.report.flush()
+        return {"totals": (self.totalres, self.totaldel, self.totalyar, self.totallinks, self.written),
+                "report_size": self.report.tell() if self.report else 0}
+
+    def dump(self, dump_path, resident):
+        key = self.dumps.key(resident.data)
+        existing = self.dumps.get(key)
+        if self.archive:
+            filename = resident.resident_fullpath
         else:
-            thisfullpath = "{}:/{}".format(drive_letter, file_record.full_path)
+            filename = "{}/{}".format(dump_path, resident.resident_fullpath)
+        source = None
+        if self.hardlinks:
+            # Never write through a path that may be linked to other files
+            old_key = self.dumped_paths.pop(filename, None)
+            if old_key is not None and self.dumps.entries.get(old_key) == filename:
+                del self.dumps.entries[old_key]
+            if existing and existing != filename:
+                source = existing
+                self.totallinks += 1
+            self.dumped_paths[filename] = key
+        self.writer.write(filename, resident.data, source, self.hardlinks)
+        if source is None:
+            self.written += len(resident.data)
+        if self.dumps.entries.get(key) is None:
+            self.dumps.put(key, filename)
+
+    def add(self, resident, yara_match=None):
+        dumped = False
+        if self.resident_path:
+            self.dump(self.resident_path, resident)
+            dumped = True
+
+        if yara_match:
+            print("\n    - YARA MATCHED: {} RESIDENT FILE: {}".format(yara_match, resident.file_path))
+            self.totalyar += 1
+            if not dumped and self.resident_yara_path:
+                self.dump(self.resident_yara_path, resident)
+                dumped = True
+
+        if not self.report:
+            return
+
+        if dumped:
+            self.totalres += 1
+            if resident.rdeleted == "DELETED":
+                self.totaldel += 1
+
+        if yara_match:
+            self.report.write("{},{},YARA MATCHED: {}\n".format(resident.rdeleted, resident.resident_fullpath, yara_match))
+        elif self.resident_path:
+            self.report.write("{},{}\n".format(resident.rdeleted, resident.resident_fullpath))
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        if self.report:
+            self.report.close()
+
+
+class YaraScanner:
+    """
+    Pipeline stage that matches the YARA rules over resident data in a
+    thread pool, yara-python releases the GIL while matching. At most
+    depth scans are queued, so the parser is held back only when YARA
+    can not keep up, and the results are passed to the callback in
+    submission order. With profile, the time between the per rule
+    callbacks of YARA is added to rule_times (the first rule of every
+    scan also carries the string search time)
+    """
+
+    def __init__(self, rules, threads, callback, profile=False):
+        self.rules = rules
+        self.callback = callback
+        self.profile = profile
+        # YARA supports up to 32 threads scanning with the same rules
+        threads = max(1, min(32, threads))
+        self.depth = threads * YARA_QUEUE_DEPTH
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.pending = collections.deque()
+        self.rule_times = collections.Counter()
+        self.scans = ContentCache()
+        self.scanned = 0
+
+    def scan(self, data):
+        if not self.profile:
+            return self.rules.match(data=data), None
+
+        times = dict()
+        last = [time.perf_counter()]
+
+        def rule_callback(rule):
+            now = time.perf_counter()
+            times["{}:{}".format(rule["namespace"], rule["rule"])] = now - last[0]
+            last[0] = now
+            return yara.CALLBACK_CONTINUE
+
+        matches = self.rules.match(data=data, callback=rule_callback, which_callbacks=yara.CALLBACK_ALL)
+        return matches, times
+
+    def submit(self, resident):
+        # Payloads already seen reuse the scan (finished or not) of the first copy
+        key = self.scans.key(resident.data)
+        future = self.scans.get(key)
+        first = future is None
+        if first:
+            future = self.pool.submit(self.scan, resident.data)
+            self.scans.put(key, future)
+            self.scanned += len(resident.data)
+        self.pending.append((resident, future, first))
+        self.flush(self.depth)
+
+    def flush(self, depth=0):
+        """
+        Hand the finished scans to the callback, waiting for the oldest
+        ones while more than depth are pending
+        """
+        while self.pending and (len(self.pending) > depth or self.pending[0][1].done()):
+            resident, future, first = self.pending.popleft()
+            matches, times = future.result()
+            if times and first:
+                self.rule_times.update(times)
+            self.callback(resident, str(matches) if matches else None)
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
+
+
+def date_filetime(date):
+    """
+    Convert a date of a SI/FN attribute into FILETIME. Dates out of range,
+    usually timestamps in milliseconds, get the error date (1977-01-01)
+    """
+    try:
+        return FILETIME_UNIX_EPOCH + round(date.timestamp() * 1000000) * 10
+    except (ValueError, OverflowError, OSError):
+        return FILETIME_ERROR
+
+
+def attribute_filetimes(data):
+    """
+    Decode the M, A, C and B dates of a SI or FN attribute in one pass
+    """
+    return (date_filetime(data.modified), date_filetime(data.accessed),
+            date_filetime(data.mft_modified), date_filetime(data.created))
+
+
+def join_macb(groups, filetimes, start=0, end=FILETIME_MAX):
+    """
+    Add the (M, A, C, B) FILETIMEs of an attribute between start and end
+    to the {filetime: macb mask} groups of a record
+    """
+    for filetime, mask in zip(filetimes, MACB_ORDER):
+        if start <= filetime <= end:
+            groups[filetime] = groups.get(filetime, 0) | mask
+
+
+# Parsed MFT record, the MACB groups are lists of (filetime, macb mask)
+MftRecord = collections.namedtuple("MftRecord", [
+    "inode", "sequence", "base_inode", "file_size", "flags", "full_path", "ftypex10", "ftypex30",
+    "timesx10", "timesx30", "asndate", "ads", "resident"])
+
+# Resident $DATA of a record, dumped and scanned by the ResidentReport/YaraScanner
+ResidentData = collections.namedtuple("ResidentData", [
+    "rdeleted", "resident_fullpath", "file_path", "data"])
+
+
+def parse_mft_record(file_record, drive_letter, file_name, resident_path, resident_yara_path, yara_scan, filters=None):
+    """
+    Parse the attributes of a MFT record. Resident data is kept in the
+    record to be dumped and scanned by the caller, and the timeline
+    events are built later too, since the non resident ADS fixups depend
+    on the previous records. With filters, only the dates of the window
+    are kept, and records out of the paths keep just their access date
+    (for the path index) without dates or resident data
+    """
+    ftypex10 = ""
+    ftypex30 = ""
+    resident = False
+    asndate = None
+    rdeleted = "ALLOCATED"
+    mft_entryx10 = dict()
+    mft_entryx30 = dict()
+    ads = list()
+    residents = list()
+    selected = filters is None or filters.selected(file_record.full_path)
+    start, end = (filters.start, filters.end) if filters else (0, FILETIME_MAX)
+
+    # PATHs Conversions
+    if OS == "Windows":
+        thisfullpath = "{}:\{}".format(drive_letter, file_record.full_path)
+    else:
+        thisfullpath = "{}:/{}".format(drive_letter, file_record.full_path)
+
+    for attribute_record in file_record.attributes():
 
-        for attribute_record in file_record.attributes():
+        if isinstance(attribute_record, RuntimeError):
+            continue
+
+        # Discard posible wrong data
+        try:
+            attribute_data = attribute_record.attribute_content
+        except:
+            continue
 
-            if isinstance(attribute_record, RuntimeError):
+        resident = attribute_record.is_resident
+
+        if attribute_record.name and attribute_record.type_name == "DATA" and attribute_record.data_size > 0:
+            ads.append([attribute_record.name, attribute_record.data_size])
+
+        
+        if attribute_data:
+            if isinstance(attribute_data, PyMftAttributeX10):
+                if selected:
+                    filetimes = attribute_filetimes(attribute_data)
+                    join_macb(mft_entryx10, filetimes, start, end)
+                    asndate = filetimes[1]
+                else:
+                    asndate = date_filetime(attribute_data.accessed)
+                ftypex10 = attribute_data.file_flags
+
+            if file_name and selected:
+                if isinstance(attribute_data, PyMftAttributeX30):
+                    join_macb(mft_entryx30, attribute_filetimes(attribute_data), start, end)
+                    ftypex30 = attribute_data.flags
+
+            if selected and resident and (resident_path or resident_yara_path or yara_scan):
+                if isinstance(attribute_data, PyMftAttributeX80) and ftypex10:
+                    if file_record.file_size != 0:
+                        if "ALLOCATED" not in file_record.flags:
+                            rdeleted = "DELETED"
+                        resident_fullpath = file_record.full_path
+                        if  attribute_record.name and attribute_record.type_name == "DATA": 
+                            resident_fullpath = "{}:{}".format(file_record.full_path, attribute_record.name)
+                        residents.append(ResidentData(rdeleted, resident_fullpath, file_record.full_path,
+                                                      attribute_data.data))
+
+    return MftRecord(file_record.entry_id, file_record.sequence, file_record.base_entry_id, file_record.file_size,
+                     file_record.flags, thisfullpath, ftypex10, ftypex30,
+                     list(mft_entryx10.items()), list(mft_entryx30.items()), asndate, ads, residents)
+
+
+def parse_mft_shard(shard):
+    """
+    Parse a range of MFT entries with its own parser and store the records
+    in a temporary run file, returns the run file path with the wall time,
+    CPU time and number of records of the parse. PyMftParser can only
+    iterate from the first entry (it needs the $MFT record and the parent
+    entries of the full paths), so the entries before the range are still
+    decoded by the parser, only the Python side of the range is skipped
+    """
+    mftfile, start, end, drive_letter, file_name, resident_path, resident_yara_path, yara_scan, filters = shard
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    parsed = 0
+    parser = PyMftParser(mftfile)
+    fd, run_path = tempfile.mkstemp(prefix="mftmactime-")
+    with os.fdopen(fd, "wb") as run:
+        chunk = list()
+        for file_record in itertools.islice(parser.entries(), start, end):
+            if isinstance(file_record, RuntimeError):
                 continue
+            chunk.append(parse_mft_record(file_record, drive_letter, file_name, resident_path,
+                                          resident_yara_path, yara_scan, filters))
+            parsed += 1
+            if len(chunk) >= SPILL_CHUNK:
+                pickle.dump(chunk, run, pickle.HIGHEST_PROTOCOL)
+                chunk = list()
+        if chunk:
+            pickle.dump(chunk, run, pickle.HIGHEST_PROTOCOL)
+    return run_path, time.perf_counter() - wall, time.process_time() - cpu, parsed
+
+
+def mft_records(mftfile, drive_letter, file_name, resident_path, resident_yara_path, yara_scan, workers=1, metrics=None, filters=None, start=0):
+    """
+    Yield the parsed records of a MFT in entry order, from the entry start.
+    With several workers the MFT is split in one entry range per worker,
+    every range is parsed in its own process and the runs are read back in
+    order, so the result is the same as a single process parse. Only the
+    Python side of the parse (attributes, dates, resident data) is split,
+    the decoding of the entries before its range is repeated by every worker
+    """
+    metrics = metrics or RunMetrics(False)
+    parser = PyMftParser(mftfile)
+    if workers <= 1:
+        parse = metrics.timed_call("attribute_decode", parse_mft_record)
+        for file_record in itertools.islice(parser.entries(), start, None):
+            if isinstance(file_record, RuntimeError):
+                continue
+            yield parse(file_record, drive_letter, file_name, resident_path,
+                        resident_yara_path, yara_scan, filters)
+        return
 
-            # Discard posible wrong data
+    entries = parser.number_of_entries()
+    shard_size = max(1, -(-(entries - start) // workers))
+    shards = [(mftfile, first, first + shard_size, drive_letter, file_name, resident_path,
+               resident_yara_path, yara_scan, filters) for first in range(start, entries, shard_size)]
+    with multiprocessing.Pool(workers) as pool:
+        for run_path, wall, cpu, parsed in pool.imap(parse_mft_shard, shards):
+            metrics.add("attribute_decode", wall, cpu, parsed)
             try:
-                attribute_data = attribute_record.attribute_content
-            except:
-                continue
+                yield from read_run(open(run_path, "rb"))
+            finally:
+                os.remove(run_path)
 
-            resident = attribute_record.is_resident
 
-            if attribute_record.name and attribute_record.type_name == "DATA" and attribute_record.data_size > 0:
-                if file_record.base_entry_id > 0 and file_record.file_size > 0:
-                    adsnores[file_record.base_entry_id] = [attribute_record.name, file_record.file_size]
-                elif file_record.base_entry_id > 0 and file_record.base_entry_id not in adsnores:
-                    adsnores[file_record.base_entry_id] = [attribute_record.name, attribute_record.data_size]
-                else:
-                    adsres.append([attribute_record.name, attribute_record.data_size])
-
-            
-            if attribute_data:
-                if isinstance(attribute_data, PyMftAttributeX10):
-                    utsm = check_mft_datetime_attribute(attribute_data, "modified")
-                    if utsm not in mft_entryx10:
-                        mft_entryx10[utsm] = "m..."
-                    else:
-                        mft_entryx10[utsm] = join_mft_datetime_attributes(mft_entryx10[utsm], 'm')
-                    
-                    utsa = check_mft_datetime_attribute(attribute_data, "accessed")
-                    if utsa not in mft_entryx10:
-                        mft_entryx10[utsa] = ".a.."
-                    else:
-                        mft_entryx10[utsa] = join_mft_datetime_attributes(mft_entryx10[utsa], 'a')
-
-                    utsc = check_mft_datetime_attribute(attribute_data, "mft_modified")
-                    if utsc not in mft_entryx10:
-                        mft_entryx10[utsc] = "..c."
-                    else:
-                        mft_entryx10[utsc] = join_mft_datetime_attributes(mft_entryx10[utsc], 'c')
-                    
-                    utsb = check_mft_datetime_attribute(attribute_data, "created")
-                    if utsb not in mft_entryx10:
-                        mft_entryx10[utsb] = "...b"
-                    else:
-                        mft_entryx10[utsb] = join_mft_datetime_attributes(mft_entryx10[utsb], 'b')
-                    ftypex10 = attribute_data.file_flags
-                    asndate = utsa
-
-                if file_name:
-                    if isinstance(attribute_data, PyMftAttributeX30):
-                        utsm = check_mft_datetime_attribute(attribute_data, "modified")
-                        if utsm not in mft_entryx30:
-                            mft_entryx30[utsm] = "m..."
-                        else:
-                            mft_entryx30[utsm] = join_mft_datetime_attributes(mft_entryx30[utsm], 'm')
-
-                        utsa = check_mft_datetime_attribute(attribute_data, "accessed")
-                        if utsa not in mft_entryx30:
-                            mft_entryx30[utsa] = ".a.."
-                        else:
-                            mft_entryx30[utsa] = join_mft_datetime_attributes(mft_entryx30[utsa], 'a')
-
-                        utsc = check_mft_datetime_attribute(attribute_data, "mft_modified")
-                        if utsc not in mft_entryx30:
-                            mft_entryx30[utsc] = "..c."
-                        else:
-                            mft_entryx30[utsc] = join_mft_datetime_attributes(mft_entryx30[utsc], 'c')
-                        
-                        utsb = check_mft_datetime_attribute(attribute_data, "created")
-                        if utsb not in mft_entryx30:
-                            mft_entryx30[utsb] = "...b"
-                        else:
-                            mft_entryx30[utsb] = join_mft_datetime_attributes(mft_entryx30[utsb], 'b')
-                        ftypex30 = attribute_data.flags
-
-                if resident and (resident_path or resident_yara_path or yara_rules):
-                    if isinstance(attribute_data, PyMftAttributeX80) and ftypex10:
-                        if file_record.file_size != 0:
-                            if yara_rules:
-                                yara_match = yara_rules.match(data=attribute_data.data)
-                                if yara_match:
-                                    print("\n    - YARA MATCHED: {} RESIDENT FILE: {}".format(yara_match, file_record.full_path))
-                                    totalyar +=1
-                            if resident_path or resident_yara_path:
-                                if "ALLOCATED" not in file_record.flags:
-                                    rdeleted = "DELETED"
-                                resident_fullpath = file_record.full_path
-                                if  attribute_record.name and attribute_record.type_name == "DATA": 
-                                    resident_fullpath = "{}:{}".format(file_record.full_path, attribute_record.name)
-                                if resident_path:
-                                    dump_resident_file(resident_path, resident_fullpath, attribute_data.data)
-                                    totalres += 1
-                                    if rdeleted == "DELETED":
-                                        totaldel += 1
-                                elif yara_match and resident_yara_path:
-                                    dump_resident_file(resident_yara_path, resident_fullpath, attribute_data.data)
-                                    totalres += 1
-                                    if rdeleted == "DELETED":
-                                        totaldel += 1                              
-
-                                with open(report_file, "a") as r:
-                                    if yara_match:
-                                        r.write("{},{},YARA MATCHED: {}\n".format(rdeleted, resident_fullpath, yara_match))
-                                    elif resident_path:
-                                        r.write("{},{}\n".format(rdeleted, resident_fullpath))
+def mft_parser(mftfile, mftout, drive_letter, file_name, timezone, resident_path, usnfile, offset, dump_path, yara_rules, resident_yara_path, max_memory=None, workers=1, yara_threads=1, yara_profile=False, dedup_hardlinks=False, resident_archive=None, state_path=None, merge_state=False, sqlite_path=None, arrow_path=None, metrics=None, filters=None, usn_offset=0, usn_min=None, checkpoint_path=None, resume=False, output_format="mactime", unsorted=False, extract=None):
+    metrics = metrics or RunMetrics(False)
+    # Bodyfile lines keep the four dates of an attribute, they are not expanded nor sorted
+    bodyfile = output_format == "bodyfile"
+    if unsorted or bodyfile:
+        mft = TimelineStream(TimelineWriter(mftout, timezone, output_format, sqlite_path, arrow_path, metrics))
+    else:
+        mft = TimelineSorter(max_memory, run_dir=checkpoint_path)
+    paths = PathIndex(drive_letter)
+    adsnores = dict()
+    usninode = None
+    state = None
+    if state_path:
+        state = TimelineState(state_path, (drive_letter, bool(file_name)))
+
+    checkpoint = None
+    saved = None
+    if checkpoint_path:
+        options = (str(getattr(mftfile, "imgfile", mftfile)), drive_letter, file_name, usnfile, offset,
+                   resident_path, resident_yara_path, bool(yara_rules), filters and vars(filters),
+                   usn_offset, usn_min)
+        checkpoint = RunCheckpoint(checkpoint_path, options)
+        if resume:
+            saved = checkpoint.load()
+            if saved:
+                print("  + RESUMING {} FROM CHECKPOINT: ENTRY {}, USN {}".format(
+                    saved["phase"].upper(), saved["mft_cursor"], saved["usn"]))
+                mft.restore_runs(saved["runs"])
+                paths = saved["paths"]
+                adsnores = saved["adsnores"]
+                usninode = saved["usninode"]
+            else:
+                print("  + NO CHECKPOINT TO RESUME, STARTING A NEW RUN")
+    phase = saved["phase"] if saved else "mft"
+
+    report = ResidentReport(resident_path, resident_yara_path, dedup_hardlinks, resident_archive,
+                            saved["report"] if saved else None)
+    dump_resident = metrics.timed_call("resident_dump", report.add)
+    scanner = None
+    if yara_rules:
+        scanner = YaraScanner(yara_rules, yara_threads, dump_resident, yara_profile)
+        scan_resident = metrics.timed_call("yara", scanner.submit)
+
+    def save_checkpoint(phase, mft_cursor=0, usn=None, usnfile=None):
+        if scanner:
+            scanner.flush()
+        checkpoint.save({"phase": phase, "mft_cursor": mft_cursor, "usn": usn, "usnfile": usnfile,
+                         "runs": mft.save_runs(), "paths": paths, "adsnores": adsnores,
+                         "usninode": usninode, "report": report.progress()})
+
+    start = time.perf_counter()
+    cpu = time.process_time()
+    parsed = 0
+    records = ()
+    if phase == "mft":
+        records = mft_records(mftfile, drive_letter, file_name, resident_path, resident_yara_path,
+                              bool(yara_rules), workers, metrics, filters,
+                              saved["mft_cursor"] if saved else 0)
+    for record in tqdm(records, desc = "  + PARSING MFT"):
+        parsed += 1
+        thisfullpath = record.full_path
+        file_size = record.file_size
+        inode = record.inode
+        flags = record.flags
+        emit = state is None or state.update(record)
+        if extract:
+            extract.add(record)
+
+        for resident in record.resident:
+            if scanner:
+                scan_resident(resident)
+            else:
+                dump_resident(resident)
+
+        # ADS of extension records are linked to their base record
+        adsres = list()
+        for ads in record.ads:
+            if record.base_inode > 0 and file_size > 0:
+                adsnores[record.base_inode] = [ads[0], file_size]
+            elif record.base_inode > 0 and record.base_inode not in adsnores:
+                adsnores[record.base_inode] = ads
+            else:
+                adsres.append(ads)
 
         # Store inode path reference
-        if asndate:
-            fpath[file_record.entry_id] = [thisfullpath, file_record.file_size, asndate]
-
-        for entry in mft_entryx10:
-            if usnfile:
-                if OS == "Windows" and ":\$Extend\$UsnJrnl" in thisfullpath and int(file_record.file_size) > BUFF_SIZE :
-                    usninode = file_record.entry_id
-                elif ":/$Extend/$UsnJrnl" in thisfullpath and int(file_record.file_size) > BUFF_SIZE :
-                    usninode = file_record.entry_id
-
-            mft.append({
-                "file_size": file_record.file_size,
-                "full_path": thisfullpath,
-                "inode": file_record.entry_id,
-                "flags": file_record.flags,
-                "date": entry,
-                "date_flags": mft_entryx10[entry],
-                "ftype": ftypex10
-                
-            })
-
-            # ADS Support
-            if adsres:
-                for adsr in adsres:
-                    thisfulladspath = "{}:{}".format(thisfullpath, adsr[0])
-                    mft.append({
-                        "file_size": adsr[1],
-                        "full_path": thisfulladspath,
-                        "inode": file_record.entry_id,
-                        "flags": file_record.flags,
-                        "date": entry,
-                        "date_flags": mft_entryx10[entry],
-                        "ftype": ftypex10
-                    })
-            if file_record.entry_id in adsnores:
-                thisfulladspath = "{}:{}".format(thisfullpath, adsnores[file_record.entry_id][0])
-                mft.append({
-                    "file_size": adsnores[file_record.entry_id][1],
-                    "full_path": thisfulladspath,
-                    "inode": file_record.entry_id,
-                    "flags": file_record.flags,
-                    "date": entry,
-                    "date_flags": mft_entryx10[entry],
-                    "ftype": ftypex10
-                })
-                del adsnores[file_record.entry_id]
-
-
-        if file_name:
-            for entry in mft_entryx30:
-                mft.append({
-                    "file_size": file_record.file_size,
-                    "full_path": "{} ($FILE_NAME)".format(thisfullpath),
-                    "inode": file_record.entry_id,
-                    "flags": file_record.flags,
-                    "date": entry,
-                    "date_flags": mft_entryx30[entry],
-                    "ftype": ftypex30
-            })
+        if record.asndate is not None:
+            paths.add_entry(inode, record.sequence, thisfullpath, file_size, record.asndate)
+
+        if usnfile and record.asndate is not None:
+            if OS == "Windows" and ":\$Extend\$UsnJrnl" in thisfullpath and int(file_size) > BUFF_SIZE :
+                usninode = inode
+            elif ":/$Extend/$UsnJrnl" in thisfullpath and int(file_size) > BUFF_SIZE :
+                usninode = inode
+
+        adspaths = ["{}:{}".format(thisfullpath, adsr[0]) for adsr in adsres]
+        if bodyfile:
+            if record.timesx10:
+                mft.writer.add_times(record.timesx10, file_size, inode, thisfullpath, flags, record.ftypex10)
+                for adsr, thisfulladspath in zip(adsres, adspaths):
+                    mft.writer.add_times(record.timesx10, adsr[1], inode, thisfulladspath, flags, record.ftypex10)
+                if inode in adsnores:
+                    thisfulladspath = "{}:{}".format(thisfullpath, adsnores[inode][0])
+                    mft.writer.add_times(record.timesx10, adsnores[inode][1], inode, thisfulladspath, flags, record.ftypex10)
+                    del adsnores[inode]
+            if file_name and record.timesx30:
+                thisfnpath = "{} ($FILE_NAME)".format(thisfullpath)
+                mft.writer.add_times(record.timesx30, file_size, inode, thisfnpath, flags, record.ftypex30)
+            if filters and record.asndate is not None:
+                adsnores.pop(inode, None)
+            continue
+
+        for date, date_flags in record.timesx10:
+            if emit:
+                mft.append(TimelineEvent(date, file_size, inode, thisfullpath, flags, date_flags, record.ftypex10))
+
+                # ADS Support
+                for adsr, thisfulladspath in zip(adsres, adspaths):
+                    mft.append(TimelineEvent(date, adsr[1], inode, thisfulladspath, flags, date_flags, record.ftypex10))
+            if inode in adsnores:
+                if emit:
+                    thisfulladspath = "{}:{}".format(thisfullpath, adsnores[inode][0])
+                    mft.append(TimelineEvent(date, adsnores[inode][1], inode, thisfulladspath, flags, date_flags, record.ftypex10))
+                del adsnores[inode]
+
+        # The ADS dates out of the window are filtered with the base ones
+        if filters and record.asndate is not None:
+            adsnores.pop(inode, None)
+
+        if file_name and emit:
+            thisfnpath = "{} ($FILE_NAME)".format(thisfullpath)
+            for date, date_flags in record.timesx30:
+                mft.append(TimelineEvent(date, file_size, inode, thisfnpath, flags, date_flags, record.ftypex30))
+
+        if checkpoint and parsed % SPILL_CHUNK == 0 and checkpoint.due():
+            save_checkpoint("mft", inode + 1)
 
     for adsnr in adsnores:
-        if adsnr in fpath:
-            thisfulladspath = "{}:{}".format(fpath[adsnr][0], adsnores[adsnr][0])
+        base = paths.entry_path(adsnr)
+        if filters and base and not (filters.in_window(base[1]) and filters.selected_path(base[0])):
+            continue
+        if base and (state is None or adsnr in state.changed):
+            thisfulladspath = "{}:{}".format(base[0], adsnores[adsnr][0])
             #if usnfile:
             #    if OS == "Windows" and ":\$Extend\$UsnJrnl:$J" in thisfulladspath and int(adsnores[adsnr][1]) > BUFF_SIZE :
             #        usninode = adsnr
             #    elif ":/$Extend/$UsnJrnl:$J" in thisfulladspath and int(adsnores[adsnr][1]) > BUFF_SIZE :
             #        usninode = adsnr
-            mft.append({
-                "file_size": adsnores[adsnr][1],
-                "full_path": thisfulladspath,
-                "inode": adsnr,
-                "flags": "ALLOCATED",
-                "date": fpath[adsnr][2],
-                "date_flags": "....",
-                "ftype": ""
-            })
-
-
-    if usnfile:
+            mft.append(TimelineEvent(base[1], adsnores[adsnr][1], adsnr, thisfulladspath,
+                                     "ALLOCATED", 0, ""))
+    adsnores.clear()
+    if checkpoint and phase == "mft":
+        phase = "usn"
+        save_checkpoint(phase)
+    metrics.add("mft_parse", time.perf_counter() - start, time.process_time() - cpu, parsed,
+                getattr(mftfile, "size", None) or os.path.getsize(mftfile), peak=True)
+
+
+    if usnfile and phase != "write":
         skip = False
         check = check_file(usnfile, offset)
         if check == "ntfs":
-            if not dump_path:
+            if saved and saved["usnfile"] and path.exists(saved["usnfile"]):
+                usnfile = saved["usnfile"]
+            elif not dump_path:
                 print ('  + Dump path is required for dump USN Journal. Skipping')
                 skip = True
             elif not usninode:
                 print ('  + USN Jornal not found. Skipping')
                 skip = True
             else:
-                usnfile = inode_seek_and_dump(usnfile, dump_path, offset, usninode, "UsnJrnl") 
+                with metrics.stage("usn_dump"):
+                    usnfile = inode_seek_and_dump(usnfile, dump_path, offset, usninode, "UsnJrnl")
+                metrics.add("usn_dump", items=1, bytes_written=os.path.getsize(usnfile))
 
         if not skip:
-            journalSize = os.path.getsize(usnfile)
-            with open(usnfile, 'rb') as i:
-                i.seek(findFirstRecord(i))
-                for _ in tqdm(generator(), desc = "  + PARSING USN"):
-                    try:
-                        nextRecord = findNextRecord(i, journalSize)
-                        recordLength = struct.unpack_from('<I', i.read(4))[0]
-                        recordData = struct.unpack_from('<2H4Q4I2H', i.read(56))
-                        usn = parseUsn(i, recordData)
-                        if usn['mftEntryNumber'] in fpath:
-                            thisfullpath = fpath[usn['mftEntryNumber']][0]
-                        else:
-                            thisfullpath =  usn['filename']
-                        thisfilename = os.path.basename(thisfullpath)
-                        if usn['filename'] not in thisfilename:
-                            thisfullpath = usn['filename']
-                        mft.append({
-                            "file_size": fpath[usn['mftEntryNumber']][1],
-                            "full_path": thisfullpath,
-                            "inode": usn['mftEntryNumber'],
-                            "flags": "(USN: {})".format(usn['reason']),
-                            "date": UTC.localize(datetime.fromtimestamp(float(usn['timestamp']) * 1e-7 - 11644473600)),
-                            "date_flags": "....",
-                            "ftype": usn['fileAttributes']
-                        })
-                        i.seek(nextRecord)
-                    except:
-                        break
+            start = time.perf_counter()
+            cpu = time.process_time()
+            parsed = 0
+            after = state.usn if state else None
+            first = usn_min
+            # The checkpoint keeps the USN of the next record to process
+            if saved and saved["usn"] is not None:
+                first = max(first or 0, saved["usn"])
+            window = filters or TimelineFilter()
+            for (entry, sequence, parent_entry, parent_sequence, usn, timestamp, reason,
+                 fileAttributes, filename) in tqdm(usn_records(usnfile, after, usn_offset, first), desc = "  + PARSING USN"):
+                parsed += 1
+                if checkpoint and parsed % SPILL_CHUNK == 0 and checkpoint.due():
+                    save_checkpoint("usn", usn=usn, usnfile=usnfile)
+                if state:
+                    state.update_usn(usn)
+                # The journal timestamps are FILETIME already
+                if not (0 <= timestamp <= FILETIME_MAX and window.in_window(timestamp)):
+                    paths.learn(entry, sequence, parent_entry, parent_sequence, filename)
+                    continue
+                thisfullpath, file_size = paths.resolve_usn(entry, sequence, parent_entry,
+                                                            parent_sequence, filename)
+                if filters and not filters.selected_path(thisfullpath):
+                    continue
+                mft.append(TimelineEvent(timestamp, file_size, entry, thisfullpath,
+                                         "(USN: {})".format(decodeReasons(reason)), 0,
+                                         decodeAttributes(fileAttributes)))
+            metrics.add("usn_parse", time.perf_counter() - start, time.process_time() - cpu, parsed,
+                        os.path.getsize(usnfile), peak=True)
+
+    if checkpoint and phase != "write":
+        phase = "write"
+        save_checkpoint(phase)
 
     print("  + GENERATING TIMELINE ...")          
-    mft_ordered_by_date = sorted(mft, key=itemgetter("date"))
-    save_mft_to_file(mft_ordered_by_date, mftout, timezone)
+    if state:
+        timeline = (event for event, new in state.merge(mft) if new or merge_state)
+        rows = save_mft_to_file(timeline, mftout, timezone, sqlite_path, arrow_path, metrics, output_format)
+        state.save()
+        print ("  + INCREMENTAL STATE: {} CHANGED ENTRIES, LAST USN: {}".format(len(state.changed), state.last_usn))
+    elif unsorted or bodyfile:
+        rows = mft.writer.close()
+    else:
+        rows = save_mft_to_file(mft, mftout, timezone, sqlite_path, arrow_path, metrics, output_format)
+    metrics.add("sort", mft.spill_seconds)
+    if checkpoint:
+        checkpoint.clear()
+    if mft.runs:
+        print ("  + TIMELINE RUNS SPILLED TO DISK: {}".format(mft.spilled))
+
+    # The timeline does not need the YARA results, only the report waits
+    if scanner:
+        with metrics.stage("yara"):
+            scanner.close()
+        metrics.add("yara", bytes_read=scanner.scanned)
+    with metrics.stage("resident_dump", bytes_written=report.written):
+        report.close()
+
+    # Extracted once the resident dumps and their report are complete
+    if extract:
+        print("  + FILES SELECTED TO EXTRACT: {}".format(len(extract.selected)))
+        extractor = ImageExtractor(extract.imgfile, extract.offset, extract.extract_path)
+        with metrics.stage("extract"):
+            extracted = extractor.extract(extract.selected, extract.rules)
+        written = sum(f[1] for f in extracted)
+        metrics.add("extract", items=len(extracted), bytes_read=extractor.read, bytes_written=written)
+        print("  + FILES EXTRACTED: {} ({} BYTES, {} SEEKS, {} ERRORS)".format(
+            len(extracted), written, extractor.seeks, extractor.errors))
+        print("  + EXTRACTION REPORT FILE: {}/extract_summary.txt".format(extract.extract_path))
+
+    hits, misses = flag_cache_stats()
+    if hits + misses:
+        print ("  + USN FLAG CACHE HIT RATE: {:.1f}% ({} HITS, {} MISSES)".format(
+            100.0 * hits / (hits + misses), hits, misses))
 
     if yara_rules:
-        print ("  + TOTAL YARA MACHED: {}".format(totalyar))
+        print ("  + TOTAL YARA MACHED: {}".format(report.totalyar))
+        print ("  + YARA SCAN DEDUP: {} PAYLOADS, {} SCANNED ({:.1f}% REUSED)".format(
+            scanner.scans.lookups, scanner.scans.lookups - scanner.scans.hits, scanner.scans.ratio()))
+        for rule, rule_time in scanner.rule_times.most_common(YARA_TOP_RULES):
+            print ("  + YARA RULE TIME: {:.3f}s {}".format(rule_time, rule))
 
     if resident_path or resident_yara_path:
-        print ("  + TOTAL RESIDENT RECOVERED: {}".format(totalres))
-        print ("  + TOTAL DELETED RESIDENT RECOVERED: {}".format(totaldel))
-        print ("  + RECOVERY REPORT FILE: {}".format(report_file))
+        print ("  + TOTAL RESIDENT RECOVERED: {}".format(report.totalres))
+        print ("  + TOTAL DELETED RESIDENT RECOVERED: {}".format(report.totaldel))
+        print ("  + RESIDENT DUMP DEDUP: {} FILES, {:.1f}% DUPLICATED PAYLOADS, {} HARDLINKED".format(
+            report.dumps.lookups, report.dumps.ratio(), report.totallinks))
+        print ("  + RECOVERY REPORT FILE: {}".format(report.report_file))
+        if resident_archive:
+            print ("  + RESIDENT ARCHIVE: {}".format(resident_archive))
+
+    return rows
 
 
 def get_args():
@@ -626,12 +2553,15 @@ def get_args():
     argparser.add_argument('-f', '--file',
                            required=True,
                            action='store',
-                           help='MFT artifact path or RAW Evidente(require --dump-path)')
+                           help='MFT artifact path or RAW Evidence (the MFT is parsed from the image, '
+                                'use --dump_path to keep a copy)')
 
     argparser.add_argument('-o', '--output',
                            required=True,
                            action='store',
-                           help='Output file: Ex: mft.csv')
+                           help='Output file: Ex: mft.csv, compressed by the extension .gz, .zst '
+                                '(requires zstandard) or .lz4 (requires lz4), or - to stream the '
+                                'timeline to stdout (the progress goes to stderr)')
 
     argparser.add_argument('-m', '--drive',
                            required=False,
@@ -668,7 +2598,7 @@ def get_args():
     argparser.add_argument('-d', '--dump_path',
                         required=False,
                         action='store',
-                        help='Dump path to allocate MFT and USN files')
+                        help='Dump path to allocate MFT and USN files (required for USN in RAW Evidence)')
 
     argparser.add_argument('-y', '--yara_rules',
                         required=False,
@@ -686,42 +2616,540 @@ def get_args():
                         help='Output path for dump only MFT resident files with yara matched '
                              'rules (not needed if -r is used )')
 
+    argparser.add_argument('--max-memory',
+                        required=False,
+                        action='store',
+                        type=parse_size,
+                        help='Memory budget for the timeline sort (Ex: 512M, 2G). Sorted runs '
+                             'are spilled to TMPDIR and merged. Default: sort in memory')
+
+    argparser.add_argument('-w', '--workers',
+                        required=False,
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='Number of processes parsing MFT entry ranges. Only the Python side '
+                             'of the parse is split, every process decodes the entries before its '
+                             'range. Default: 1')
+
+    argparser.add_argument('--yara-threads',
+                        required=False,
+                        action='store',
+                        type=int,
+                        default=YARA_THREADS,
+                        help='Number of threads matching yara rules over resident data '
+                             '(max 32). Default: {}'.format(YARA_THREADS))
+
+    argparser.add_argument('--yara-profile',
+                        required=False,
+                        action='store_true',
+                        help='Measure the time spent by every yara rule and show the slowest ones')
+
+    argparser.add_argument('--dedup-hardlinks',
+                        required=False,
+                        action='store_true',
+                        help='Hardlink dumped resident files with the same content to the first '
+                             'copy instead of writing them again')
+
+    argparser.add_argument('--resident-archive',
+                        required=False,
+                        action='store',
+                        help='Write the dumped resident files into a single archive '
+                             '(Ex: resident.zip, resident.tar.gz) instead of the dump folder')
+
+    argparser.add_argument('--state',
+                        required=False,
+                        action='store',
+                        help='Incremental mode: state directory of the host. Only the events of new '
+                             'or changed MFT entries and new USN records are written')
+
+    argparser.add_argument('--merge',
+                        required=False,
+                        action='store_true',
+                        help='With --state, write the whole timeline merging the new events into '
+                             'the one stored in the state')
+
+    argparser.add_argument('--sqlite',
+                        required=False,
+                        action='store',
+                        help='Also write the timeline to an indexed SQLite file for '
+                             '"mftmactime query". Ex: timeline.db')
+
+    argparser.add_argument('--arrow',
+                        required=False,
+                        action='store',
+                        help='Also write the timeline as Parquet (Ex: timeline.parquet) or Arrow '
+                             'IPC (Ex: timeline.arrow) with typed columns. Requires pyarrow')
+
+    argparser.add_argument('--from',
+                        required=False,
+                        action='store',
+                        dest='date_from',
+                        help='Only events from this date of the --timezone. Ex: "2022-09-07 11:00:00"')
+
+    argparser.add_argument('--to',
+                        required=False,
+                        action='store',
+                        dest='date_to',
+                        help='Only events up to this date of the --timezone. Ex: "2022-09-09 11:00:00"')
+
+    argparser.add_argument('--include',
+                        required=False,
+                        action='append',
+                        help='Only events of the paths under this volume path prefix (whole path components), case insensitive '
+                             '(can be repeated). Ex: Users/')
+
+    argparser.add_argument('--exclude',
+                        required=False,
+                        action='append',
+                        help='No events of the paths under this volume path prefix (whole path components), case insensitive '
+                             '(can be repeated). Ex: Windows/WinSxS/')
+
+    argparser.add_argument('--usn-offset',
+                        required=False,
+                        action='store',
+                        type=parse_size,
+                        default=0,
+                        help='Start reading the USN Journal at this byte offset (Ex: 2G), the older '
+                             'journal regions are not read')
+
+    argparser.add_argument('--usn-min',
+                        required=False,
+                        action='store',
+                        type=int,
+                        help='Only USN records with this USN number or greater')
+
+    argparser.add_argument('--output-format',
+                        required=False,
+                        action='store',
+                        choices=['mactime', 'jsonl', 'bodyfile'],
+                        default='mactime',
+                        help='Format of the timeline: mactime CSV and JSON Lines rows, or TSK bodyfile '
+                             'with one unsorted line per attribute (for mactime/plaso). Default: mactime')
+
+    argparser.add_argument('--unsorted',
+                        required=False,
+                        action='store_true',
+                        help='Write the events as they are parsed, without sorting them, so the '
+                             'output can be read while the parse is running')
+
+    argparser.add_argument('--checkpoint',
+                        required=False,
+                        action='store',
+                        help='Save a checkpoint of the run in this directory every {} minutes, '
+                             'the sorted runs of the timeline are spilled there'.format(CHECKPOINT_SECONDS // 60))
+
+    argparser.add_argument('--resume',
+                        required=False,
+                        action='store_true',
+                        help='Resume the run from the last checkpoint of --checkpoint')
+
+    argparser.add_argument('-x', '--extract',
+                        required=False,
+                        action='store',
+                        help='RAW evidence: extract the allocated files selected with --extract-glob, '
+                             '--extract-ext and --extract-yara (all of them if none) into this directory')
+
+    argparser.add_argument('--extract-glob',
+                        required=False,
+                        action='append',
+                        help='Extract the files of this volume path glob, case insensitive (can be '
+                             'repeated). Ex: "Windows/System32/config/*"')
+
+    argparser.add_argument('--extract-ext',
+                        required=False,
+                        action='append',
+                        help='Extract the files with this extension (can be repeated). Ex: evtx')
+
+    argparser.add_argument('--extract-yara',
+                        required=False,
+                        action='store',
+                        help='Extract only the selected files whose first {} KB match these yara '
+                             'rules'.format(EXTRACT_HEADER // 1024))
+
+    argparser.add_argument('--metrics',
+                        required=False,
+                        action='store',
+                        help='Write the wall/CPU time, items, bytes read/written and peak memory '
+                             'of every stage of the run to this file. Ex: metrics.json')
+
+    argparser.add_argument('--metrics-format',
+                        required=False,
+                        action='store',
+                        choices=['json', 'prometheus'],
+                        default='json',
+                        help='Format of the --metrics file (Prometheus text format for the node '
+                             'exporter textfile collector). Default: json')
+
+    argparser.add_argument('--profile',
+                        required=False,
+                        action='store',
+                        help='Profile the run and write the profile to this file (pstats file '
+                             'with cProfile, text or .html report with pyinstrument)')
+
+    argparser.add_argument('--profiler',
+                        required=False,
+                        action='store',
+                        choices=['cprofile', 'pyinstrument'],
+                        default='cprofile',
+                        help='Profiler used by --profile. Default: cprofile')
+
     args = argparser.parse_args()
 
     return args
 
 
+def parse_query_date(value, timezone):
+    """
+    Convert an ISO date (Ex: 2022-09-07 11:29:48) of the query timezone into FILETIME
+    """
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = pytz.timezone(timezone).localize(date) if timezone else UTC.localize(date)
+    return datetime_to_filetime(date)
+
+
+def get_query_args(argv):
+    argparser = argparse.ArgumentParser(
+        prog='mftmactime query',
+        description='Query a timeline stored with --sqlite by time range, inode or path subtree')
+
+    argparser.add_argument('database',
+                           action='store',
+                           help='SQLite timeline written with --sqlite')
+
+    argparser.add_argument('-b', '--begin',
+                           required=False,
+                           action='store',
+                           help='First date of the range (Ex: "2022-09-07 11:00:00")')
+
+    argparser.add_argument('-e', '--end',
+                           required=False,
+                           action='store',
+                           help='End date of the range, not included (Ex: "2022-09-07 11:10:00")')
+
+    argparser.add_argument('-i', '--inode',
+                           required=False,
+                           action='store',
+                           type=int,
+                           help='MFT entry number')
+
+    argparser.add_argument('-p', '--path',
+                           required=False,
+                           action='store',
+                           help='Path subtree (Ex: "C:/Windows/System32/")')
+
+    argparser.add_argument('-tz', '--timezone',
+                           required=False,
+                           action='store',
+                           help='Timezone of the dates of the range and of the output (UTC Default)')
+
+    argparser.add_argument('-o', '--output',
+                           required=False,
+                           action='store',
+                           help='Output file. Default: stdout')
+
+    return argparser.parse_args(argv)
+
+
+def query_main(argv):
+    args = get_query_args(argv)
+    if not path.exists(args.database):
+        print('+ No timeline database')
+        return 1
+    if args.timezone and args.timezone not in pytz.all_timezones:
+        print('+ Invalid timezone string!')
+        return 1
+
+    try:
+        start = parse_query_date(args.begin, args.timezone) if args.begin else None
+        end = parse_query_date(args.end, args.timezone) if args.end else None
+    except ValueError as e:
+        print('+ Invalid date: {}'.format(e))
+        return 1
+    format_date = DateFormatter(args.timezone).format
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        out.write("Date,Size,Type,Mode,UID,GID,Meta,File Name\n")
+        for date, file_size, macb, mode, inode, full_path, fflag in query_timeline(
+                args.database, start, end, args.inode, args.path):
+            out.write(timeline_row(format_date(date), file_size, macb, mode, inode, full_path, fflag))
+    finally:
+        if args.output:
+            out.close()
+
+
+def read_batch_manifest(manifest):
+    """
+    Read the jobs of a batch manifest, a CSV file with a header and the
+    columns mft, output and optionally usn, drive, timezone, dump_path and
+    offset (partition offset of RAW images)
+    """
+    jobs = list()
+    with open(manifest, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            row = {key.strip().lower(): (value or "").strip() for key, value in row.items() if key}
+            if not row.get("mft"):
+                continue
+            jobs.append({"mft": row["mft"],
+                         "output": row.get("output") or "{}.csv".format(path.basename(row["mft"])),
+                         "usn": row.get("usn") or None,
+                         "drive": row.get("drive") or "C",
+                         "timezone": row.get("timezone") or None,
+                         "dump_path": row.get("dump_path") or None,
+                         "offset": row.get("offset") or "0"})
+    return jobs
+
+
+def run_batch_job(job, file_name, sort_memory):
+    """
+    Run one batch job with its output and progress in <output>.log,
+    returns the job summary. Errors are reported, not raised
+    """
+    summary = dict(job)
+    summary.update({"status": "ok", "error": None, "rows": 0, "seconds": 0.0,
+                    "input_bytes": sum(os.path.getsize(job[key]) for key in ("mft", "usn")
+                                       if job[key] and path.isfile(job[key]))})
+    start = time.perf_counter()
+    try:
+        if job["timezone"] and job["timezone"] not in pytz.all_timezones:
+            raise ValueError("invalid timezone: {}".format(job["timezone"]))
+        offset = int(job["offset"])
+        check = check_file(job["mft"], offset)
+        if not check:
+            raise ValueError("input file not supported: {}".format(job["mft"]))
+        mftfile = ImageMftFile(job["mft"], offset) if check == "ntfs" else job["mft"]
+        os.makedirs(os.path.dirname(os.path.abspath(job["output"])), exist_ok=True)
+        with open(job["output"] + ".log", "w") as log:
+            with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+                summary["rows"] = mft_parser(mftfile, job["output"], job["drive"], file_name,
+                                             job["timezone"], None, job["usn"], offset, job["dump_path"],
+                                             None, None, sort_memory)
+    except Exception as e:
+        summary["status"] = "failed"
+        summary["error"] = "{}: {}".format(type(e).__name__, e)
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+
+def batch_job_process(job, file_name, sort_memory, conn):
+    conn.send(run_batch_job(job, file_name, sort_memory))
+    conn.close()
+
+
+def run_batch(jobs, workers, file_name, sort_memory=None):
+    """
+    Run the jobs with up to workers processes, one process per job so a
+    crash only fails its own job. sort_memory is split into a per-job
+    sort buffer of sort_memory // workers (the max_memory of each job's
+    timeline sort), it is not a limit on the rest of the memory of the
+    jobs. Yields the job summaries as they end
+    """
+    job_memory = sort_memory // workers if sort_memory else None
+    pending = collections.deque(enumerate(jobs))
+    running = dict()
+    while pending or running:
+        while pending and len(running) < workers:
+            index, job = pending.popleft()
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=batch_job_process,
+                                              args=(job, file_name, job_memory, sender))
+            process.start()
+            sender.close()
+            running[process.sentinel] = (process, index, job, receiver, time.perf_counter())
+            print("- [{}/{}] STARTED {} -> {}".format(index + 1, len(jobs), job["mft"], job["output"]))
+
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            process, index, job, receiver, start = running.pop(sentinel)
+            try:
+                summary = receiver.recv()
+            except EOFError:
+                summary = None
+            process.join()
+            receiver.close()
+            if summary is None:
+                summary = dict(job)
+                summary.update({"status": "crashed", "rows": 0, "input_bytes": 0,
+                                "seconds": time.perf_counter() - start,
+                                "error": "exit code {}".format(process.exitcode)})
+            summary["job"] = index + 1
+            seconds = summary["seconds"] or 1e-9
+            summary["rows_per_sec"] = summary["rows"] / seconds
+            summary["mb_per_sec"] = summary["input_bytes"] / seconds / 1024 ** 2
+            print("- [{}/{}] {} {} ({:.1f}s, {} ROWS{})".format(
+                index + 1, len(jobs), summary["status"].upper(), job["mft"], summary["seconds"],
+                summary["rows"], ", " + summary["error"] if summary["error"] else ""))
+            yield summary
+
+
+def get_batch_args(argv):
+    argparser = argparse.ArgumentParser(
+        prog='mftmactime batch',
+        description='Run many MFT/USN timeline jobs from a CSV manifest in parallel')
+
+    argparser.add_argument('manifest',
+                           action='store',
+                           help='CSV manifest with header: mft,usn,drive,timezone,output[,dump_path][,offset]')
+
+    argparser.add_argument('-j', '--jobs',
+                           required=False,
+                           action='store',
+                           type=int,
+                           default=os.cpu_count() or 1,
+                           help='Number of jobs running at the same time. Default: number of CPUs')
+
+    argparser.add_argument('-n', '--filenameattr',
+                           required=False,
+                           action='store_true',
+                           help='Extract X30 Attributes file_name too.')
+
+    argparser.add_argument('--sort-memory', '--max-memory',
+                           required=False,
+                           action='store',
+                           type=parse_size,
+                           help='Memory of the timeline sort buffers, split evenly into a per-job sort '
+                                'budget of SORT_MEMORY / workers (Ex: 16G). It is not a limit on the '
+                                'memory of the jobs: the MFT parser, path index and outputs are not '
+                                'counted. --max-memory is kept as an alias')
+
+    argparser.add_argument('-s', '--summary',
+                           required=False,
+                           action='store',
+                           default='batch_summary.json',
+                           help='JSON summary with the status and throughput of every job. '
+                                'Default: batch_summary.json')
+
+    return argparser.parse_args(argv)
+
+
+def batch_main(argv):
+    args = get_batch_args(argv)
+    if not path.exists(args.manifest):
+        print('+ No manifest file')
+        return 1
+
+    jobs = read_batch_manifest(args.manifest)
+    if not jobs:
+        print('+ No jobs in manifest')
+        return 1
+    workers = max(1, min(args.jobs, len(jobs)))
+    print("- BATCH: {} JOBS, {} WORKERS".format(len(jobs), workers))
+
+    start = time.perf_counter()
+    summaries = sorted(run_batch(jobs, workers, args.filenameattr, args.sort_memory),
+                       key=lambda summary: summary["job"])
+    summary = {"jobs": summaries,
+               "total_jobs": len(jobs),
+               "failed_jobs": sum(1 for s in summaries if s["status"] != "ok"),
+               "total_rows": sum(s["rows"] for s in summaries),
+               "seconds": time.perf_counter() - start}
+    with open(args.summary, "w") as f:
+        json.dump(summary, f, indent=2)
+    print("- BATCH SUMMARY: {} ({} FAILED)".format(args.summary, summary["failed_jobs"]))
+    return 1 if summary["failed_jobs"] else 0
+
+
 def main():
 
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        return query_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        return batch_main(sys.argv[2:])
+
     args = get_args()
+    if args.output == "-":
+        # The timeline goes to the real stdout, the progress to stderr
+        sys.stdout = sys.stderr
+        if not args.max_memory and not args.unsorted:
+            args.max_memory = STREAM_MEMORY
     inputfile = args.file
     offset = int(args.offset)
     dump_path = args.dump_path
     inputusn = args.usn
+    metrics = RunMetrics(bool(args.metrics))
 
     if not path.exists(inputfile):
         print('+ No input file')
         return 1
 
-    # CHECK MFT INPUT
+    # CHECK MFT INPUT (the MFT of a RAW image is read once the options are valid)
     check = check_file(inputfile, offset)
     if not check:
         print('+ Input file not supported')
         return 1
-    elif check == "ntfs":
-        print("- RAW Evidence Detected")
-        if not dump_path:
-            print('+ Dump path is required for RAW Evidence')
+
+    compression = output_compression(args.output)
+    if compression == "zstd" and zstandard is None:
+        print('+ zstandard is required for .zst output (pip install zstandard)')
+        return 1
+
+    if compression == "lz4" and lz4frame is None:
+        print('+ lz4 is required for .lz4 output (pip install lz4)')
+        return 1
+
+    if args.arrow and pa is None:
+        print('+ pyarrow is required for --arrow (pip install pyarrow)')
+        return 1
+
+    if args.merge and not args.state:
+        print('+ --merge requires a --state directory')
+        return 1
+
+    if args.unsorted and (args.state or args.checkpoint):
+        print('+ --unsorted can not be used with --state or --checkpoint')
+        return 1
+
+    if args.output_format == "bodyfile" and (args.state or args.checkpoint or args.sqlite or args.arrow):
+        print('+ bodyfile output can not be used with --state, --checkpoint, --sqlite or --arrow')
+        return 1
+
+    if args.resume and not args.checkpoint:
+        print('+ --resume requires a --checkpoint directory')
+        return 1
+
+    if args.checkpoint and (args.state or args.resident_archive):
+        print('+ --checkpoint can not be used with --state or --resident-archive')
+        return 1
+
+    extract = None
+    if args.extract or args.extract_glob or args.extract_ext or args.extract_yara:
+        if not args.extract or check != "ntfs":
+            print('+ File extraction requires RAW evidence and an --extract directory')
             return 1
-        mftfile = inode_seek_and_dump(inputfile, dump_path, offset, 0, "MFT")
-    else:
-        print("- MFT FILE Detected")
-        mftfile = inputfile
+        if args.checkpoint:
+            print('+ --extract can not be used with --checkpoint')
+            return 1
+        extract_rules = None
+        if args.extract_yara:
+            try:
+                extract_rules = yara.compile(args.extract_yara)
+            except Exception as e:
+                print('+ Yara error: {}'.format(e))
+                return 1
+        extract = ExtractSelection(inputfile, offset, args.extract, args.extract_glob,
+                                   args.extract_ext, extract_rules)
+
+    if args.profile and args.profiler == "pyinstrument" and pyinstrument is None:
+        print('+ pyinstrument is required for --profiler pyinstrument (pip install pyinstrument)')
+        return 1
 
     timezone = args.timezone
     if timezone and timezone not in pytz.all_timezones:
         print('+ Invalid timezone string!')
         return 1
+
+    filters = None
+    if args.date_from or args.date_to or args.include or args.exclude:
+        if args.state:
+            print('+ --from, --to, --include and --exclude can not be used with --state')
+            return 1
+        try:
+            filters = TimelineFilter(parse_query_date(args.date_from, timezone) if args.date_from else None,
+                                     parse_query_date(args.date_to, timezone) if args.date_to else None,
+                                     args.include, args.exclude)
+        except ValueError as e:
+            print('+ Invalid date: {}'.format(e))
+            return 1
     
     mftout = args.output
     drive_letter = args.drive
@@ -753,10 +3181,48 @@ def main():
             print('+ Invalid yara rules path')
             return 1
 
-    mft_parser(mftfile, mftout, drive_letter, file_name, timezone, resident_path, inputusn,
-               offset, dump_path, yara_rules, resident_yara_path)
+    if check == "ntfs":
+        print("- RAW Evidence Detected")
+        if dump_path and args.resume and path.exists("{}/MFT".format(dump_path)):
+            print("  + RESUMING WITH THE DUMPED MFT")
+            mftfile = "{}/MFT".format(dump_path)
+        elif dump_path:
+            with metrics.stage("mft_dump"):
+                mftfile = inode_seek_and_dump(inputfile, dump_path, offset, 0, "MFT")
+            metrics.add("mft_dump", items=1, bytes_written=os.path.getsize(mftfile))
+        else:
+            mftfile = ImageMftFile(inputfile, offset)
+    else:
+        print("- MFT FILE Detected")
+        mftfile = inputfile
+
+    parser_options = dict(max_memory=args.max_memory, workers=args.workers,
+                          yara_threads=args.yara_threads, yara_profile=args.yara_profile,
+                          dedup_hardlinks=args.dedup_hardlinks, resident_archive=args.resident_archive,
+                          state_path=args.state, merge_state=args.merge, sqlite_path=args.sqlite,
+                          arrow_path=args.arrow, metrics=metrics, filters=filters,
+                          usn_offset=args.usn_offset, usn_min=args.usn_min,
+                          checkpoint_path=args.checkpoint, resume=args.resume,
+                          output_format=args.output_format, unsorted=args.unsorted, extract=extract)
+    parser_args = (mftfile, mftout, drive_letter, file_name, timezone, resident_path, inputusn,
+                   offset, dump_path, yara_rules, resident_yara_path)
+    if args.profile:
+        profile_call(args.profiler, args.profile, mft_parser, *parser_args, **parser_options)
+        print("  + PROFILE: {}".format(args.profile))
+    else:
+        mft_parser(*parser_args, **parser_options)
+
+    for session in IMAGE_SESSIONS.values():
+        print("  + IMAGE {}: {} EXTRACTIONS, OPEN/SETUP TIME SAVED: {:.2f}s".format(
+            session.imgfile, session.extractions, session.saved))
+        metrics.add("image_open", session.img_time + sum(session.fs_times.values()),
+                    items=1 + len(session.fs_times))
+
+    if args.metrics:
+        metrics.save(args.metrics, args.metrics_format)
+        print("  + METRICS: {}".format(args.metrics))
 
 
 # *** MAIN LOOP ***
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,191 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import mftmactime
+
+
+FILETIME = 132223104000000000
+STRIPPED_USN = 32 * 1024 ** 3
+
+
+def usn_record(usn, entry, timestamp, name):
+    filename = name.encode("utf-16-le")
+    length = (mftmactime.USN_RECORD_V2_SIZE + len(filename) + 7) & ~7
+    record = bytearray(length)
+    mftmactime.USN_RECORD_V2.pack_into(record, 0, length, 2, 0, entry | (1 << 48), 5 | (5 << 48), usn,
+                                       timestamp, 0x100, 0, 0, 0x20, len(filename),
+                                       mftmactime.USN_RECORD_V2_SIZE)
+    record[mftmactime.USN_RECORD_V2_SIZE:mftmactime.USN_RECORD_V2_SIZE + len(filename)] = filename
+    return bytes(record)
+
+
+def write_stripped_journal(usnfile, records):
+    """
+    Write a $J without its sparse part, the first record is at offset 0
+    with the USN STRIPPED_USN. Returns the USN of every record
+    """
+    usns = list()
+    usn = STRIPPED_USN
+    with open(usnfile, "wb") as f:
+        for index in range(records):
+            record = usn_record(usn, 1000 + index, FILETIME + index * 10000000, "usn{}.txt".format(index))
+            f.write(record)
+            usns.append(usn)
+            usn += len(record)
+    return usns
+
+
+def base_record(inode, name):
+    return mftmactime.MftRecord(inode, 1, 0, 10, "ALLOCATED", "C:/d2/{}".format(name), "ARCHIVE", "",
+                                [(FILETIME + inode, 15)], [], FILETIME + inode, [], [])
+
+
+def extension_record(inode, base_inode, ads_name, file_size):
+    return mftmactime.MftRecord(inode, 1, base_inode, file_size, "ALLOCATED", "C:/", "", "",
+                                [], [], None, [[ads_name, 7000]], [])
+
+
+class TimelineStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="mftmactime-test-")
+        self.mftfile = os.path.join(self.tmp, "MFT")
+        open(self.mftfile, "wb").close()
+        self.state_path = os.path.join(self.tmp, "state")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_parser(self, records, output, usnfile=None, **kwargs):
+        output = os.path.join(self.tmp, output)
+        with mock.patch.object(mftmactime, "mft_records", lambda *args: iter(records)):
+            mftmactime.mft_parser(self.mftfile, output, "C", False, None, None, usnfile, 0, None,
+                                  None, None, **kwargs)
+        with open(output) as f:
+            return f.read()
+
+    def test_changed_extension_record_replaces_base_ads(self):
+        records = [base_record(219, "f219.txt"), base_record(300, "f300.txt"),
+                   extension_record(549, 219, "ads549", 5000)]
+        self.run_parser(records, "first.csv", state_path=self.state_path)
+
+        # Only the extension record changes, its base is parsed before it
+        records[2] = extension_record(549, 219, "ads549", 999999)
+        merged = self.run_parser(records, "merged.csv", state_path=self.state_path, merge_state=True)
+        full = self.run_parser(records, "full.csv")
+
+        self.assertEqual(merged, full)
+        self.assertIn("999999", [line.split(",")[1] for line in merged.splitlines() if "ads549" in line])
+        self.assertIn("C:/d2/f219.txt ", merged)
+
+    def test_removed_extension_record_removes_base_ads(self):
+        records = [base_record(219, "f219.txt"), extension_record(549, 219, "ads549", 5000)]
+        self.run_parser(records, "first.csv", state_path=self.state_path)
+
+        merged = self.run_parser(records[:1], "merged.csv", state_path=self.state_path, merge_state=True)
+
+        self.assertEqual(merged, self.run_parser(records[:1], "full.csv"))
+        self.assertNotIn("ads549", merged)
+
+    def test_stripped_journal_increments(self):
+        usnfile = os.path.join(self.tmp, "J")
+        records = [base_record(219, "f219.txt")]
+        usns = write_stripped_journal(usnfile, 500)
+        first = self.run_parser(records, "first.csv", usnfile, state_path=self.state_path)
+
+        # The journal grows, the next run only gets the new records
+        usns = write_stripped_journal(usnfile, 1000)
+        delta = self.run_parser(records, "delta.csv", usnfile, state_path=self.state_path)
+
+        self.assertEqual(first.count("(USN: "), 500)
+        self.assertEqual(delta.count("(USN: "), 500)
+        self.assertIn("usn999.txt", delta)
+        self.assertNotIn("usn499.txt", delta)
+        self.assertEqual(mftmactime.TimelineState(self.state_path, ("C", False)).usn, usns[-1])
+
+
+class Interrupted(Exception):
+    pass
+
+
+class RunCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="mftmactime-test-")
+        self.mftfile = os.path.join(self.tmp, "MFT")
+        open(self.mftfile, "wb").close()
+        self.usnfile = os.path.join(self.tmp, "J")
+        write_stripped_journal(self.usnfile, 1000)
+        self.records = [base_record(219, "f219.txt"), base_record(300, "f300.txt")]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_parser(self, output, **kwargs):
+        output = os.path.join(self.tmp, output)
+        with mock.patch.object(mftmactime, "mft_records", lambda *args: iter(self.records)):
+            mftmactime.mft_parser(self.mftfile, output, "C", False, None, None, self.usnfile, 0, None,
+                                  None, None, **kwargs)
+        with open(output) as f:
+            return f.read()
+
+    def test_resume_in_the_usn_phase_of_a_stripped_journal(self):
+        checkpoint_path = os.path.join(self.tmp, "checkpoint")
+        usn_records = mftmactime.usn_records
+
+        def interrupted(*args):
+            for parsed, record in enumerate(usn_records(*args)):
+                if parsed == 650:
+                    raise Interrupted()
+                yield record
+
+        with mock.patch.object(mftmactime, "CHECKPOINT_SECONDS", 0), \
+                mock.patch.object(mftmactime, "SPILL_CHUNK", 100):
+            with mock.patch.object(mftmactime, "usn_records", interrupted):
+                with self.assertRaises(Interrupted):
+                    self.run_parser("resumed.csv", checkpoint_path=checkpoint_path)
+            resumed = self.run_parser("resumed.csv", checkpoint_path=checkpoint_path, resume=True)
+
+        self.assertEqual(resumed, self.run_parser("full.csv"))
+        self.assertEqual(resumed.count("(USN: "), 1000)
+
+
+class TimelineFilterTest(unittest.TestCase):
+
+    def test_prefixes_match_on_a_separator(self):
+        filters = mftmactime.TimelineFilter(include=["\\Users\\"], exclude=["users/admin"])
+
+        self.assertTrue(filters.selected_path("C:/Users"))
+        self.assertTrue(filters.selected_path("C:/Users/test.txt"))
+        self.assertFalse(filters.selected_path("C:/UsersBackup/test.txt"))
+        self.assertFalse(filters.selected_path("C:/Users/Admin/test.txt"))
+        self.assertTrue(filters.selected_path("C:/Users/Administrator/test.txt"))
+
+
+class UsnRecordsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="mftmactime-test-")
+        self.usnfile = os.path.join(self.tmp, "J")
+        self.usns = write_stripped_journal(self.usnfile, 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_stripped_journal_after_and_first(self):
+        middle = self.usns[500]
+        after = [record[4] for record in mftmactime.usn_records(self.usnfile, after=middle)]
+        first = [record[4] for record in mftmactime.usn_records(self.usnfile, first=middle)]
+
+        self.assertEqual(after, self.usns[501:])
+        self.assertEqual(first, self.usns[500:])
+
+    def test_stripped_journal_past_the_last_usn(self):
+        self.assertEqual(list(mftmactime.usn_records(self.usnfile, after=self.usns[-1])), [])
+
+
+if __name__ == "__main__":
+    unittest.main()